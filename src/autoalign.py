@@ -1,18 +1,51 @@
 import numpy as np
 import cv2
 import sys
-from PIL import Image
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from getopt import getopt, GetoptError
+from scipy.spatial import cKDTree
+
+from imagearray import load_image, image_size, gray_image, crop_image, as_array
+from timing import timed
 
 MIN_MATCH_COUNT = 10
-MIN_GRID_COUNT = 100
 MAX_CV_SIZE = 2000
 INNER_MARGIN = 5
 GRID_SIZE = 10
+# guided matching: distance in pixels of the reduced image from the position predicted by the homography
+GUIDED_RADIUS = 5.0
+GUIDED_SAMPLE = 2000
+# a guided match must be clearly better than the next candidate, close enough in descriptor space
+# (relative to the largest distance of the backend's descriptors), and the best match back
+GUIDED_RATIO = 0.8
+# the prediction by the homography is corrected by the median offset of this many nearest matches
+# of the sample, for distortions that a homography does not capture
+GUIDED_NEIGHBOURS = 5
+GUIDED_MAX_DISTANCE = 0.3
+FEATURE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'imagealign')
+SIFT_PARAMS = {}
+ORB_PARAMS = {'nfeatures': 10000}
+# multiscale matching: tiles of the first image at full resolution, matched within the window
+# predicted by the coarse homography, allowing for an error of some pixels at coarse resolution
+FINE_TILE_SIZE = 1024
+FINE_ERROR = 4
+FINE_RATIO = 0.7
+MEMORY_BUDGET = 2 ** 30
+# rough peak memory of SIFT per pixel of input, for its scale space of float images
+SIFT_BYTES_PER_PIXEL = 256
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+def cv_scale(w, h):
+	return min(MAX_CV_SIZE / h, MAX_CV_SIZE / w, 1)
 
-def pil_to_cv(im_pil):
-	im_cv = cv2.cvtColor(np.array(im_pil), cv2.COLOR_RGB2GRAY)
+def image_to_cv(image):
+	im_cv = gray_image(as_array(image))
 	h, w = im_cv.shape
-	scale = min(MAX_CV_SIZE / h, MAX_CV_SIZE / w, 1)
+	scale = cv_scale(w, h)
 	return scale, cv2.resize(im_cv, (0,0), fx=scale, fy=scale)
 
 def scale_points(scale, pts_scaled):
@@ -20,36 +53,321 @@ def scale_points(scale, pts_scaled):
 	return np.float32(pts).reshape(-1,1,2)
 
 def get_flann():
-	FLANN_INDEX_KDTREE = 1
 	index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
 	search_params = dict(checks = 50)
 	return cv2.FlannBasedMatcher(index_params, search_params)
 
-def get_sift_matches(im1, im2, min_count):
-	sift = cv2.SIFT_create()
-	kp1, ds1 = sift.detectAndCompute(im1, None)
-	kp2, ds2 = sift.detectAndCompute(im2, None)
-	flann = get_flann()
-	matches = flann.knnMatch(ds1, ds2, k=2)
+def get_flann_lsh():
+	index_params = dict(algorithm = FLANN_INDEX_LSH, table_number = 6, key_size = 12, multi_probe_level = 1)
+	search_params = dict(checks = 50)
+	return cv2.FlannBasedMatcher(index_params, search_params)
+
+# detector, its parameters, and whether descriptors are binary
+DETECTORS = {
+	'sift': (cv2.SIFT_create, SIFT_PARAMS, False),
+	'orb': (cv2.ORB_create, ORB_PARAMS, True),
+	'akaze': (cv2.AKAZE_create, {}, True),
+	'brisk': (cv2.BRISK_create, {}, True),
+}
+
+class FeatureBackend:
+	def __init__(self, name='sift', bruteforce=False):
+		if name not in DETECTORS:
+			raise ValueError('Unknown feature detector: ' + name)
+		self.name = name
+		self.create, self.params, self.binary = DETECTORS[name]
+		self.bruteforce = bruteforce
+
+	def detect(self, im_cv):
+		detector = self.create(**self.params)
+		kp, ds = detector.detectAndCompute(im_cv, None)
+		points = np.float32([k.pt for k in kp]).reshape(-1, 2)
+		if ds is None:
+			ds = np.zeros((0, detector.descriptorSize()), \
+				dtype=np.uint8 if self.binary else np.float32)
+		return points, ds
+
+	def norm(self):
+		return cv2.NORM_HAMMING if self.binary else cv2.NORM_L2
+
+	def matcher(self):
+		if self.bruteforce:
+			return cv2.BFMatcher(self.norm())
+		elif self.binary:
+			return get_flann_lsh()
+		else:
+			return get_flann()
+
+SIFT = FeatureBackend('sift')
+
+def ratio_matches(matches, f):
+	# LSH may find fewer than two neighbours
+	return [pair[0] for pair in matches if len(pair) == 2 and pair[0].distance < f * pair[1].distance]
+
+class FeatureCache:
+	def __init__(self, directory=FEATURE_CACHE_DIR):
+		self.directory = directory
+		self.features = {}
+		self.matchers = {}
+		self.lock = threading.Lock()
+
+	def key(self, im_cv, backend):
+		digest = hashlib.sha1()
+		digest.update(str((im_cv.shape, backend.name, sorted(backend.params.items()), \
+			cv2.__version__)).encode())
+		digest.update(np.ascontiguousarray(im_cv).data)
+		return backend.name + '-' + digest.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key + '.npz')
+
+	def read(self, key, backend):
+		try:
+			with np.load(self.path(key)) as data:
+				ds = data['descriptors']
+				return data['points'], ds if backend.binary else ds.astype(np.float32)
+		except (OSError, KeyError, ValueError):
+			return None
+
+	def write(self, key, points, descriptors):
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			tmp = self.path(key) + '.%d.tmp' % threading.get_ident()
+			# SIFT descriptors are whole numbers below 256, so bytes are lossless and compress faster
+			packed = descriptors.astype(np.uint8)
+			if not np.array_equal(packed, descriptors):
+				packed = descriptors
+			with open(tmp, 'wb') as handler:
+				np.savez_compressed(handler, points=points, descriptors=packed)
+			os.replace(tmp, self.path(key))
+		except OSError:
+			pass
+
+	@timed('detect')
+	def detect(self, im_cv, backend=SIFT):
+		key = self.key(im_cv, backend)
+		with self.lock:
+			if key in self.features:
+				return key, self.features[key]
+		features = self.read(key, backend)
+		if features is None:
+			features = backend.detect(im_cv)
+			self.write(key, *features)
+		with self.lock:
+			self.features[key] = features
+		return key, features
+
+	def matcher(self, key, descriptors, backend=SIFT):
+		# index of the descriptors, trained once per image
+		with self.lock:
+			if (key, backend.bruteforce) not in self.matchers:
+				matcher = backend.matcher()
+				matcher.add([descriptors])
+				matcher.train()
+				self.matchers[(key, backend.bruteforce)] = matcher
+			return self.matchers[(key, backend.bruteforce)]
+
+feature_cache = FeatureCache()
+
+def detect_pair(im1, im2, backend=SIFT):
+	with ThreadPoolExecutor(2) as executor:
+		future1 = executor.submit(feature_cache.detect, im1, backend)
+		future2 = executor.submit(feature_cache.detect, im2, backend)
+		return future1.result(), future2.result()
+
+def get_feature_matches(im1, im2, min_count, backend=SIFT):
+	(_, (pts1, ds1)), (key2, (pts2, ds2)) = detect_pair(im1, im2, backend)
+	if len(ds1) < 2 or len(ds2) < 2:
+		return pts1, pts2, None
+	matches = feature_cache.matcher(key2, ds2, backend).knnMatch(ds1, k=2)
+	return pts1, pts2, strictest_ratio_matches(matches, min_count)
+
+def strictest_ratio_matches(matches, min_count):
 	for f in range(3, 8):
 		f = f / 10
-		good = [m for (m,n) in matches if m.distance < f * n.distance]
+		good = ratio_matches(matches, f)
 		if len(good) >= min_count:
-			return kp1, kp2, good
-	return kp1, kp2, None
+			return good
+	return None
 
-def get_matching_points(im1_pil, im2_pil, min_count):
-	scale1, im1_cv = pil_to_cv(im1_pil)
-	scale2, im2_cv = pil_to_cv(im2_pil)
-	kp1, kp2, good = get_sift_matches(im1_cv, im2_cv, min_count)
+def get_matching_points(im1, im2, min_count, backend=SIFT):
+	scale1, im1_cv = image_to_cv(im1)
+	scale2, im2_cv = image_to_cv(im2)
+	pts1, pts2, good = get_feature_matches(im1_cv, im2_cv, min_count, backend)
 	if good is None:
 		return None
-	pts1 = scale_points(scale1, [kp1[m.queryIdx].pt for m in good])
-	pts2 = scale_points(scale2, [kp2[m.trainIdx].pt for m in good])
+	pts1 = scale_points(scale1, [pts1[m.queryIdx] for m in good])
+	pts2 = scale_points(scale2, [pts2[m.trainIdx] for m in good])
 	return pts1, pts2
 
-def get_homography(im1_pil, im2_pil):
-	pair_of_points = get_matching_points(im1_pil, im2_pil, MIN_MATCH_COUNT)
+def crop_gray(image, box):
+	return gray_image(crop_image(as_array(image), box))
+
+def fine_windows(hom, w1, h1, w2, h2, margin):
+	for y in range(0, h1, FINE_TILE_SIZE):
+		for x in range(0, w1, FINE_TILE_SIZE):
+			box1 = (x, y, min(x + FINE_TILE_SIZE, w1), min(y + FINE_TILE_SIZE, h1))
+			corners = np.float32([[box1[0], box1[1]], [box1[2], box1[1]], \
+				[box1[0], box1[3]], [box1[2], box1[3]]]).reshape(-1,1,2)
+			predicted = cv2.perspectiveTransform(corners, hom).reshape(-1,2)
+			x_min, y_min = np.floor(predicted.min(axis=0) - margin)
+			x_max, y_max = np.ceil(predicted.max(axis=0) + margin)
+			box2 = (max(int(x_min), 0), max(int(y_min), 0), min(int(x_max), w2), min(int(y_max), h2))
+			if box2[0] < box2[2] and box2[1] < box2[3]:
+				yield box1, box2
+
+def match_fine_tile(im1, im2, box1, box2, hom, margin, backend=SIFT):
+	pts1, ds1 = backend.detect(crop_gray(im1, box1))
+	pts2, ds2 = backend.detect(crop_gray(im2, box2))
+	if len(ds1) < 2 or len(ds2) < 2:
+		return empty_matches()
+	good = ratio_matches(backend.matcher().knnMatch(ds1, ds2, k=2), FINE_RATIO)
+	if len(good) == 0:
+		return empty_matches()
+	pts1 = np.float32([pts1[m.queryIdx] for m in good]) + np.float32(box1[:2])
+	pts2 = np.float32([pts2[m.trainIdx] for m in good]) + np.float32(box2[:2])
+	distances = np.float32([m.distance for m in good])
+	predicted = cv2.perspectiveTransform(pts1.reshape(-1,1,2), hom).reshape(-1,2)
+	close = np.linalg.norm(predicted - pts2, axis=1) <= margin
+	return pts1[close], pts2[close], distances[close]
+
+def empty_matches():
+	return np.zeros((0,2), dtype=np.float32), np.zeros((0,2), dtype=np.float32), \
+		np.zeros(0, dtype=np.float32)
+
+@timed('fine_matches')
+def get_fine_matches(im1, im2, backend=SIFT):
+	hom = get_homography(im1, im2, backend=backend)
+	if hom is None:
+		return None
+	w1, h1 = image_size(im1)
+	w2, h2 = image_size(im2)
+	margin = FINE_ERROR / min(cv_scale(w1, h1), cv_scale(w2, h2))
+	windows = list(fine_windows(hom, w1, h1, w2, h2, margin))
+	if len(windows) == 0:
+		return None
+	# as many tiles at a time as fit in the memory budget
+	tile_bytes = max((b1[2]-b1[0]) * (b1[3]-b1[1]) + (b2[2]-b2[0]) * (b2[3]-b2[1]) \
+		for (b1, b2) in windows) * SIFT_BYTES_PER_PIXEL
+	workers = max(1, min(os.cpu_count() or 1, MEMORY_BUDGET // tile_bytes))
+	with ThreadPoolExecutor(workers) as executor:
+		results = list(executor.map(lambda w: match_fine_tile(im1, im2, w[0], w[1], hom, margin, backend), \
+			windows))
+	return tuple(np.concatenate([r[i] for r in results]) for i in range(3))
+
+def get_matching_points_fine(im1, im2, min_count, backend=SIFT):
+	matches = get_fine_matches(im1, im2, backend)
+	if matches is None or len(matches[0]) < min_count:
+		return None
+	pts1, pts2, _ = matches
+	return pts1.reshape(-1,1,2), pts2.reshape(-1,1,2)
+
+@timed('guided_matches')
+def get_guided_matches(im1, im2, grid_size, backend=SIFT):
+	scale1, im1_cv = image_to_cv(im1)
+	scale2, im2_cv = image_to_cv(im2)
+	(_, (pts1, ds1)), (key2, (pts2, ds2)) = detect_pair(im1_cv, im2_cv, backend)
+	if len(ds1) < 2 or len(ds2) < 2:
+		return None
+	# a sample of the features suffices for the global homography
+	sample = np.arange(0, len(ds1), max(1, len(ds1) // GUIDED_SAMPLE))
+	matches = feature_cache.matcher(key2, ds2, backend).knnMatch(ds1[sample], k=2)
+	good = strictest_ratio_matches(matches, MIN_MATCH_COUNT)
+	if good is None:
+		return None
+	src = np.float32([pts1[sample[m.queryIdx]] for m in good]).reshape(-1,1,2)
+	dst = np.float32([pts2[m.trainIdx] for m in good]).reshape(-1,1,2)
+	hom, _ = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+	if hom is None:
+		return None
+	predicted = local_prediction(pts1, src.reshape(-1,2), dst.reshape(-1,2), hom)
+	h1, w1 = im1_cv.shape
+	cells = np.minimum(pts1[:,1] * grid_size // h1, grid_size - 1) * grid_size + \
+		np.minimum(pts1[:,0] * grid_size // w1, grid_size - 1)
+	tree = cKDTree(pts2)
+	tree_back = cKDTree(predicted)
+	max_distance = GUIDED_MAX_DISTANCE * max_descriptor_distance(ds1, backend)
+	matches = []
+	# per cell, only features of the second image near the predicted positions are compared;
+	# of the confident matches the closest in descriptor space is kept, and cells without one
+	# are left out
+	for cell in np.unique(cells):
+		idx1 = np.flatnonzero(cells == cell)
+		neighbours = tree.query_ball_point(predicted[idx1], GUIDED_RADIUS)
+		counts = [len(n) for n in neighbours]
+		if sum(counts) == 0:
+			continue
+		query = np.repeat(idx1, counts)
+		train = np.concatenate(neighbours).astype(int)
+		distances = descriptor_distances(ds1[query], ds2[train], backend)
+		query, train, distances = ratio_test(query, train, distances)
+		keep = (distances <= max_distance) & \
+			np.array([mutual(q, t, ds1, ds2, pts2, tree_back, backend) for (q, t) in zip(query, train)], dtype=bool)
+		if not keep.any():
+			continue
+		best = np.flatnonzero(keep)[np.argmin(distances[keep])]
+		matches.append((query[best], train[best], distances[best]))
+	if len(matches) == 0:
+		return None
+	query, train, distances = zip(*matches)
+	return pts1[list(query)] / np.float32(scale1), pts2[list(train)] / np.float32(scale2), \
+		np.float32(distances)
+
+def local_prediction(pts, src, dst, hom):
+	offsets = dst - cv2.perspectiveTransform(src.reshape(-1,1,2), hom).reshape(-1,2)
+	k = min(GUIDED_NEIGHBOURS, len(src))
+	_, nearest = cKDTree(src).query(pts, k=k)
+	nearest = nearest.reshape(len(pts), k)
+	return cv2.perspectiveTransform(pts.reshape(-1,1,2), hom).reshape(-1,2) + \
+		np.median(offsets[nearest], axis=1)
+
+def descriptor_distances(ds1, ds2, backend=SIFT):
+	if backend.binary:
+		return np.unpackbits(np.bitwise_xor(ds1, ds2), axis=1).sum(axis=1).astype(np.float32)
+	return np.linalg.norm(ds1 - ds2, axis=1)
+
+def max_descriptor_distance(ds, backend=SIFT):
+	# the number of bits of binary descriptors, and for others twice the largest norm
+	if backend.binary:
+		return ds.shape[1] * 8
+	return 2 * float(np.linalg.norm(ds, axis=1).max(initial=0))
+
+def ratio_test(query, train, distances):
+	# per feature of the first image, its best candidate if clearly better than the second best
+	order = np.lexsort((distances, query))
+	query, train, distances = query[order], train[order], distances[order]
+	first = np.flatnonzero(np.r_[True, query[1:] != query[:-1]])
+	second = first + 1
+	has_second = second < len(query)
+	has_second[has_second] = query[second[has_second]] == query[first[has_second]]
+	second_distances = np.full(len(first), np.inf, dtype=np.float32)
+	second_distances[has_second] = distances[second[has_second]]
+	confident = distances[first] < GUIDED_RATIO * second_distances
+	best = first[confident]
+	return query[best], train[best], distances[best]
+
+def mutual(q, t, ds1, ds2, pts2, tree_back, backend=SIFT):
+	# the feature of the second image, matched back to features of the first image predicted
+	# near it, has the same feature as best match
+	back = np.int64(tree_back.query_ball_point(pts2[t], GUIDED_RADIUS))
+	distances = descriptor_distances(ds1[back], ds2[[t] * len(back)], backend)
+	return back[np.argmin(distances)] == q
+
+def best_per_bucket(pts1, pts2, distances, w, h, grid_size):
+	buckets = {}
+	for i in np.argsort(distances, kind='stable'):
+		x, y = round(pts1[i][0]), round(pts1[i][1])
+		bucket = (x * grid_size // w, y * grid_size // h)
+		if bucket not in buckets:
+			buckets[bucket] = ((x,y), (round(pts2[i][0]), round(pts2[i][1])))
+	return list(buckets.values())
+
+@timed('homography')
+def get_homography(im1, im2, multiscale=False, backend=SIFT):
+	if multiscale:
+		pair_of_points = get_matching_points_fine(im1, im2, MIN_MATCH_COUNT, backend)
+	else:
+		pair_of_points = get_matching_points(im1, im2, MIN_MATCH_COUNT, backend)
 	if pair_of_points is None:
 		return None
 	pts1, pts2 = pair_of_points
@@ -97,13 +415,13 @@ def add_point(points, p, hom, inv, w1, h1, w2, h2):
 		return
 	points.append((p, q))
 
-def get_corner_point_pairs(im1, im2):
-	hom = get_homography(im1, im2)
+def get_corner_point_pairs(im1, im2, multiscale=False, backend=SIFT):
+	hom = get_homography(im1, im2, multiscale, backend)
 	if hom is None:
 		return []
 	inv = np.linalg.inv(hom)
-	w1, h1 = im1.size
-	w2, h2 = im2.size
+	w1, h1 = image_size(im1)
+	w2, h2 = image_size(im2)
 	p1 = (INNER_MARGIN, INNER_MARGIN)
 	p2 = (INNER_MARGIN, h1-INNER_MARGIN-1)
 	p3 = (w1-INNER_MARGIN-1, INNER_MARGIN)
@@ -119,28 +437,40 @@ def get_corner_point_pairs(im1, im2):
 	add_point(points, p4, hom, inv, w1, h1, w2, h2)
 	return points
 
-def get_grid_point_pairs(im1, im2):
-	pair_of_points = get_matching_points(im1, im2, MIN_GRID_COUNT)
-	if pair_of_points is None:
+def get_grid_point_pairs(im1, im2, multiscale=False, backend=SIFT, grid_size=GRID_SIZE):
+	if multiscale:
+		matches = get_fine_matches(im1, im2, backend)
+	else:
+		matches = get_guided_matches(im1, im2, grid_size, backend)
+	if matches is None:
 		return []
-	pts1, pts2 = pair_of_points
-	pts1 = [(round(p[0][0]),round(p[0][1])) for p in pts1]
-	pts2 = [(round(p[0][0]),round(p[0][1])) for p in pts2]
-	w, h = im1.size
-	buckets = {}
-	for (x,y), p2 in zip(pts1, pts2):
-		x_bucket = x * GRID_SIZE // w
-		y_bucket = y * GRID_SIZE // h
-		bucket = (x_bucket, y_bucket)
-		buckets[bucket] = ((x,y), p2)
-	return list(buckets.values())
+	w, h = image_size(im1)
+	return best_per_bucket(*matches, w, h, grid_size)
 
 if __name__ == '__main__':
-	if len(sys.argv) != 3:
+	multiscale = False
+	name = 'sift'
+	bruteforce = False
+	grid_size = GRID_SIZE
+	try:
+		opts, vals = getopt(sys.argv[1:], 'mf:bg:', ['multiscale', 'features=', 'bruteforce', 'grid='])
+	except GetoptError as err:
+		print(err)
+		sys.exit(1)
+	if len(vals) != 2:
 		print('Required are two images')
-	in_file1 = sys.argv[1]
-	in_file2 = sys.argv[2]
-	im1 = Image.open(in_file1).convert('RGB')
-	im2 = Image.open(in_file2).convert('RGB')
-	point_pairs = get_point_pairs(im1, im2)
+		sys.exit(1)
+	for opt, val in opts:
+		if opt in ('-m', '--multiscale'):
+			multiscale = True
+		elif opt in ('-f', '--features'):
+			name = val
+		elif opt in ('-b', '--bruteforce'):
+			bruteforce = True
+		elif opt in ('-g', '--grid'):
+			grid_size = int(val)
+	im1 = load_image(vals[0])
+	im2 = load_image(vals[1])
+	point_pairs = get_grid_point_pairs(im1, im2, multiscale, FeatureBackend(name, bruteforce), \
+		grid_size)
 	print(point_pairs)
@@ -0,0 +1,83 @@
+import sys
+import os
+import csv
+import time
+import traceback
+import cv2
+from multiprocessing import Pool
+from getopt import getopt, GetoptError
+from PIL import Image
+
+from imagedistortion import CompiledTransform, split_point_pairs, distort_image, warp_image, \
+		complete_point_pairs_size, read_point_pairs
+from imagearray import load_image, save_image, image_size
+
+MODES = ['t', 'q', 'b', 'w']
+
+def read_manifest(path):
+	with open(path) as handler:
+		reader = csv.reader(handler, delimiter=' ')
+		rows = [row for row in reader if len(row) > 0 and not row[0].startswith('#')]
+	jobs = []
+	for row in rows:
+		if len(row) != 5 or row[3] not in MODES:
+			raise ValueError('Expected image1 image2 pointpairs mode output, got: ' + ' '.join(row))
+		jobs.append(tuple(row))
+	return jobs
+
+def distort(size1, image2, point_pairs, poly_mode):
+	point_pairs = complete_point_pairs_size(point_pairs, size1, image_size(image2))
+	w, h = size1
+	if poly_mode == 'w':
+		pts_dst, pts_src, matches = split_point_pairs(point_pairs)
+		return warp_image(image2, pts_src, pts_dst, matches, w, h)
+	transform = CompiledTransform(point_pairs, poly_mode)
+	return distort_image(image2, transform.pairs, w, h, poly_mode == 'b')
+
+def run_job(job):
+	(image_file1, image_file2, point_file, poly_mode, out_file) = job
+	start = time.perf_counter()
+	try:
+		# of the first image only the size is needed
+		size1 = Image.open(image_file1).size
+		image2 = load_image(image_file2)
+		point_pairs = read_point_pairs(point_file)
+		save_image(distort(size1, image2, point_pairs, poly_mode), out_file)
+		return job, time.perf_counter() - start, None
+	except Exception:
+		return job, time.perf_counter() - start, traceback.format_exc()
+
+def init_worker():
+	# parallelism comes from the processes
+	cv2.setNumThreads(1)
+
+def run_jobs(jobs, workers):
+	failures = []
+	start = time.perf_counter()
+	with Pool(workers, initializer=init_worker) as pool:
+		for job, elapsed, error in pool.imap_unordered(run_job, jobs):
+			if error is None:
+				print('%.2fs %s' % (elapsed, job[4]))
+			else:
+				print('%.2fs FAILED %s' % (elapsed, job[4]))
+				print(error)
+				failures.append(job)
+	print('%d jobs, %d failed, %.2fs with %d workers' % \
+		(len(jobs), len(failures), time.perf_counter() - start, workers))
+	return failures
+
+if __name__ == '__main__':
+	workers = os.cpu_count()
+	try:
+		opts, vals = getopt(sys.argv[1:], 'j:', ['jobs='])
+	except GetoptError as err:
+		print(err)
+		sys.exit(1)
+	if len(vals) != 1:
+		print('Required is a manifest file, with lines: image1 image2 pointpairs mode output')
+		sys.exit(1)
+	for opt, val in opts:
+		if opt in ('-j', '--jobs'):
+			workers = int(val)
+	failures = run_jobs(read_manifest(vals[0]), workers)
+	sys.exit(1 if len(failures) > 0 else 0)
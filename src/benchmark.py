@@ -0,0 +1,609 @@
+import sys
+import os
+import time
+import math
+import json
+import random
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import cv2
+from getopt import getopt, GetoptError
+from PIL import Image
+
+from bilinear import BilinearMap, BilinearBuffers
+from imagedistortion import get_grid, cached_grid, polygon_mask, polygon_labels, polygon_source_maps, compact_maps, \
+	warp_grid, CompiledTransform, complete_point_pairs_size, triangulate, \
+	merge_triangles, distort_image, warp_image_approx, normalize_polygon, triangles_to_affine, \
+	quads_to_transform
+from imagearray import save_image
+from tiledrender import render_tiles
+from displacementmap import export_map, DisplacementMap
+import autoalign
+from autoalign import get_grid_point_pairs
+
+BILINEAR_SIZES = [64, 256, 1024]
+REMAP_SIZE = (3000, 2000)
+REMAP_POINTS = 50
+ORACLE_SAMPLES = 2000
+# rendering differs from the replaced per-polygon renderer if more than this fraction of pixels
+# differ by more than this many levels
+REFERENCE_LEVELS = 8
+REFERENCE_FRACTION = 0.01
+REPEATS = 5
+# of a tile, as larger grids are not cached
+GRID_SIZE = (1024, 1024)
+SAVE_SIZE = (1000, 1000)
+SAVE_TYPES = [np.uint8, np.uint16, np.float32]
+SAVE_CHANNELS = [1, 2, 3, 4, 6]
+SAVE_EXTENSIONS = ['png', 'tif', 'npy']
+# merging triangles into quadrilaterals, for these numbers of point pairs
+MERGE_POINTS = [1000, 2000, 5000, 10000]
+# the pipeline benchmark, on synthetic documents of these sizes in megapixels, with these numbers
+# of point pairs taken from the known distortion
+PIPELINE_SIZES = [1, 10, 50]
+PIPELINE_POINTS = [4, 50, 200, 1000]
+PIPELINE_REPEATS = 3
+# further runs of a stage are skipped once it has taken this long
+STAGE_BUDGET = 30
+PIPELINE_MODES = ['t', 'q', 'b', 'w']
+POINT_SAMPLES = 10000
+# points found automatically farther than this many pixels from the known distortion are wrong
+ALIGN_TOLERANCE = 3
+# pages in the proportions of A4, in portrait
+PAGE_ASPECT = math.sqrt(2)
+BAND_ROWS = 1024
+# a duration is a regression if it grows by more than the threshold, and by at least the minimum
+REGRESSION_THRESHOLD = 0.2
+MIN_REGRESSION_SECONDS = 0.01
+# fields that identify a result, so that it can be compared with the same one in a baseline
+KEY_FIELDS = ['stage', 'path', 'size', 'megapixels', 'points', 'pixels']
+
+def best_time(f, repeats=REPEATS):
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		f()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+def random_quad(size, jitter):
+	corners = [(0, 0), (size, 0), (size, size), (0, size)]
+	return tuple((x + random.uniform(-jitter, jitter) + jitter, y + random.uniform(-jitter, jitter) + jitter) \
+		for (x, y) in corners)
+
+def bench_bilinear(sizes=BILINEAR_SIZES):
+	random.seed(0)
+	results = []
+	for size in sizes:
+		quad1 = random_quad(size, size / 5)
+		quad2 = random_quad(size, size / 5)
+		transform = BilinearMap(quad1, quad2)
+		w = h = round(size * 1.4) + 1
+		mask = np.array(polygon_mask(quad1, w, h)) > 0
+		rows, cols = np.nonzero(mask)
+		n = len(rows)
+		buffers = BilinearBuffers()
+		xs, ys, out_x, out_y = buffers.points(n)
+		xs[:] = cols
+		ys[:] = rows
+		def fast():
+			# the whole grid of the bounding box, rather than only the pixels in the quad
+			transform.map_grid_fast(get_grid(w, h))
+		def points():
+			transform.map_points(xs, ys, out_x, out_y, buffers)
+		time_fast = best_time(fast)
+		time_points = best_time(points)
+		# both against the scalar evaluation, on a sample of the pixels in the quad
+		sample = np.random.default_rng(0).choice(n, min(n, ORACLE_SAMPLES), replace=False)
+		grid = np.dstack((xs[sample], ys[sample]))
+		# in double precision, as the scalar evaluation follows the type of its arguments
+		oracle = transform.map_grid_slow(grid.astype(np.float64))[0]
+		error_fast = np.abs(transform.map_grid_fast(grid)[0] - oracle).max()
+		error_points = np.abs(np.stack((out_x[sample], out_y[sample]), axis=1) - oracle).max()
+		results.append({'size': size, 'pixels': n, 'fast_s': time_fast, 'points_s': time_points, \
+			'fast_error': float(error_fast), 'points_error': float(error_points)})
+	return results
+
+def print_bilinear(results):
+	print('%8s %10s %14s %14s %12s %12s' % \
+		('size', 'pixels', 'fast Mpx/s', 'points Mpx/s', 'fast error', 'points error'))
+	for r in results:
+		print('%8d %10d %14.1f %14.1f %12.2e %12.2e' % (r['size'], r['pixels'], \
+			r['pixels'] / r['fast_s'] / 1e6, r['pixels'] / r['points_s'] / 1e6, \
+			r['fast_error'], r['points_error']))
+
+def synthetic_image(w, h, seed=0):
+	rng = np.random.default_rng(seed)
+	small = (rng.random((h // 8 + 1, w // 8 + 1, 3)) * 255).astype(np.uint8)
+	return cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+
+def synthetic_point_pairs(w, h, n, seed=0):
+	random.seed(seed)
+	point_pairs = []
+	for _ in range(n):
+		x, y = random.randrange(w // 20, w - w // 20), random.randrange(h // 20, h - h // 20)
+		point_pairs.append(((x + random.randint(-w // 200, w // 200), y + random.randint(-h // 200, h // 200)), \
+			(x, y)))
+	return complete_point_pairs_size(point_pairs, (w, h), (w, h))
+
+def bench_remap(size=REMAP_SIZE):
+	w, h = size
+	source = synthetic_image(w, h)
+	point_pairs = synthetic_point_pairs(w, h, REMAP_POINTS)
+	results = []
+	bilinear = CompiledTransform(point_pairs, 'b')
+	labels = polygon_labels(bilinear.pairs, 0, 0, w, h)
+	map_x, map_y = polygon_source_maps(bilinear.pairs, labels, 0, 0, True)
+	warp = CompiledTransform(point_pairs, 'w')
+	grid = warp_grid(warp.tps, w, h)
+	for path, map1, map2, interpolation in (('bilinear', map_x, map_y, cv2.INTER_CUBIC), \
+			('warp', grid, None, cv2.INTER_LINEAR)):
+		compact1, compact2 = compact_maps(map1, map2, (w, h))
+		float_bytes = map1.nbytes + (0 if map2 is None else map2.nbytes)
+		results.append({'path': path, 'pixels': w * h, \
+			'float_bytes': float_bytes, 'fixed_bytes': compact1.nbytes + compact2.nbytes, \
+			'float_s': best_time(lambda: cv2.remap(source, map1, map2, interpolation)), \
+			'convert_s': best_time(lambda: compact_maps(map1, map2, (w, h))), \
+			'fixed_s': best_time(lambda: cv2.remap(source, compact1, compact2, interpolation))})
+	return results
+
+def print_remap(results):
+	print('%-10s %10s %12s %12s %10s %10s %10s' % \
+		('path', 'pixels', 'float MB', 'fixed MB', 'float s', 'convert s', 'fixed s'))
+	for r in results:
+		print('%-10s %10d %12.1f %12.1f %10.4f %10.4f %10.4f' % (r['path'], r['pixels'], \
+			r['float_bytes'] / 1e6, r['fixed_bytes'] / 1e6, r['float_s'], r['convert_s'], r['fixed_s']))
+
+def reference_distort_image(source, pairs, w, h, bilinear):
+	# the renderer that distort_image replaced, which transformed a crop of the source for
+	# each polygon and pasted it through the polygon's mask
+	source = Image.fromarray(source)
+	target = Image.new(mode='RGB', size=(w,h), color='black')
+	for (t1, t2) in pairs:
+		t1_norm, x1, y1, w1, h1 = normalize_polygon(t1)
+		t2_norm, x2, y2, w2, h2 = normalize_polygon(t2)
+		w3 = max(w1, w2)
+		h3 = max(h1, h2)
+		sub_source = source.crop((x1, y1, x1+w3, y1+h3))
+		if len(t1_norm) == 3:
+			af = triangles_to_affine(t2_norm, t1_norm)
+			sub_target = sub_source.transform(sub_source.size, Image.AFFINE, af, resample=Image.BICUBIC)
+		elif bilinear:
+			grid_warped = BilinearMap(t2_norm, t1_norm).map_grid_fast(get_grid(w3, h3))
+			sub_target = Image.fromarray(cv2.remap(np.array(sub_source), grid_warped[:, :, 0], \
+				grid_warped[:, :, 1], cv2.INTER_CUBIC))
+		else:
+			sub_target = Image.fromarray(cv2.warpPerspective(np.array(sub_source), \
+				quads_to_transform(t1_norm, t2_norm), (w3, h3)))
+		target.paste(sub_target, (x2, y2), polygon_mask(t2_norm, w3, h3))
+	return np.asarray(target)
+
+def bench_reference(size=REMAP_SIZE):
+	w, h = size
+	source = synthetic_image(w, h)
+	point_pairs = synthetic_point_pairs(w, h, REMAP_POINTS)
+	results = []
+	for mode in ('t', 'q', 'b'):
+		pairs = CompiledTransform(point_pairs, mode).pairs
+		reference = reference_distort_image(source, pairs, w, h, mode == 'b')
+		distorted = distort_image(source, pairs, w, h, mode == 'b')
+		difference = np.abs(reference.astype(np.int32) - distorted).max(axis=2)
+		results.append({'mode': mode, 'pixels': w * h, \
+			'reference_s': best_time(lambda: reference_distort_image(source, pairs, w, h, mode == 'b')), \
+			'distort_s': best_time(lambda: distort_image(source, pairs, w, h, mode == 'b')), \
+			'mean_difference': float(difference.mean()), \
+			'differing': float((difference > REFERENCE_LEVELS).mean()), \
+			'max_difference': int(difference.max())})
+	return results
+
+def print_reference(results):
+	print('%6s %10s %12s %10s %10s %12s %8s' % \
+		('mode', 'pixels', 'reference s', 'distort s', 'mean diff', 'differing %', 'max'))
+	for r in results:
+		print('%6s %10d %12.4f %10.4f %10.3f %12.3f %8d' % (r['mode'], r['pixels'], r['reference_s'], \
+			r['distort_s'], r['mean_difference'], 100 * r['differing'], r['max_difference']))
+
+def bench_maps(size=REMAP_SIZE):
+	# displacement maps in the exact formats, applied against distorting directly
+	w, h = size
+	source = synthetic_image(w, h)
+	point_pairs = synthetic_point_pairs(w, h, REMAP_POINTS)
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		for mode in ('t', 'q', 'b'):
+			transform = CompiledTransform(point_pairs, mode)
+			distorted = distort_image(source, transform.pairs, w, h, mode == 'b')
+			for fmt in ('int16', 'float32'):
+				path = os.path.join(directory, mode + fmt + '.npy')
+				export_s = best_time(lambda: export_map(transform, (w, h), (w, h), path, fmt), 1)
+				displacement_map = DisplacementMap(path)
+				applied = np.zeros_like(source)
+				apply_s = best_time(lambda: displacement_map.apply(source, applied), 1)
+				results.append({'mode': mode, 'format': fmt, 'pixels': w * h, 'export_s': export_s, \
+					'apply_s': apply_s, 'differing': int((applied != distorted).any(axis=2).sum())})
+	return results
+
+def print_maps(results):
+	print('%6s %8s %10s %10s %10s %10s' % ('mode', 'format', 'pixels', 'export s', 'apply s', 'differing'))
+	for r in results:
+		print('%6s %8s %10d %10.4f %10.4f %10d' % (r['mode'], r['format'], r['pixels'], \
+			r['export_s'], r['apply_s'], r['differing']))
+
+def read_saved(path, channels):
+	# as written, in the channel order of the array
+	if path.endswith('.npy'):
+		return np.load(path)
+	if path.endswith('.tif'):
+		import tifffile
+		return tifffile.imread(path)
+	if channels == 2:
+		return np.asarray(Image.open(path))
+	image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+	if channels == 3:
+		return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+	if channels == 4:
+		return cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+	return image
+
+def bench_save(size=SAVE_SIZE):
+	# every type and number of channels that rendering can produce, either saved exactly or
+	# refused with a ValueError
+	w, h = size
+	rng = np.random.default_rng(0)
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		for dtype in SAVE_TYPES:
+			for channels in SAVE_CHANNELS:
+				shape = (h, w) if channels == 1 else (h, w, channels)
+				scale = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1
+				image = (rng.random(shape) * scale).astype(dtype)
+				for extension in SAVE_EXTENSIONS:
+					path = os.path.join(directory, 'saved.' + extension)
+					record = {'type': np.dtype(dtype).name, 'channels': channels, 'format': extension}
+					try:
+						record['save_s'] = best_time(lambda: save_image(image, path), 1)
+					except ValueError:
+						record['result'] = 'refused'
+					else:
+						saved = read_saved(path, channels)
+						exact = saved.dtype == image.dtype and np.array_equal(saved, image)
+						record['result'] = 'exact' if exact else 'different'
+					results.append(record)
+	return results
+
+def print_save(results):
+	print('%8s %9s %7s %10s %10s' % ('type', 'channels', 'format', 'result', 'save s'))
+	for r in results:
+		save_s = '%10.4f' % r['save_s'] if 'save_s' in r else '%10s' % '-'
+		print('%8s %9d %7s %10s %s' % (r['type'], r['channels'], r['format'], r['result'], save_s))
+
+def bench_grid(size=GRID_SIZE):
+	w, h = size
+	def fresh():
+		cached_grid.cache_clear()
+		get_grid(w, h)
+	return [{'pixels': w * h, 'fresh_s': best_time(fresh), 'cached_s': best_time(lambda: get_grid(w, h))}]
+
+def print_grid(results):
+	print('%10s %10s %10s' % ('pixels', 'fresh s', 'cached s'))
+	for r in results:
+		print('%10d %10.4f %10.6f' % (r['pixels'], r['fresh_s'], r['cached_s']))
+
+def bench_merge(counts=MERGE_POINTS, size=REMAP_SIZE):
+	w, h = size
+	results = []
+	for n in counts:
+		point_pairs = synthetic_point_pairs(w, h, n)
+		triangle_pairs, neighbors = triangulate(point_pairs)
+		quads = [p for p in merge_triangles(triangle_pairs, neighbors) if len(p[0]) == 4]
+		results.append({'points': len(point_pairs), 'triangles': len(triangle_pairs), 'quads': len(quads), \
+			'delaunay_s': best_time(lambda: triangulate(point_pairs)), \
+			'neighbors_s': best_time(lambda: merge_triangles(triangle_pairs, neighbors)), \
+			'index_s': best_time(lambda: merge_triangles(triangle_pairs))})
+	return results
+
+def print_merge(results):
+	print('%8s %10s %8s %10s %12s %10s' % ('points', 'triangles', 'quads', 'delaunay s', 'neighbors s', 'index s'))
+	for r in results:
+		print('%8d %10d %8d %10.4f %12.4f %10.4f' % (r['points'], r['triangles'], r['quads'], \
+			r['delaunay_s'], r['neighbors_s'], r['index_s']))
+
+def page_size(megapixels):
+	w = round(math.sqrt(megapixels * 1e6 / PAGE_ASPECT))
+	return w, round(w * PAGE_ASPECT)
+
+def document_image(w, h, seed=0):
+	# lines of words of random glyphs on white paper, with a frame, in RGB
+	rng = np.random.default_rng(seed)
+	line_height = max(h // 80, 8)
+	glyph = max(line_height // 4, 2)
+	cols, rows = w // glyph, h // glyph
+	line_rows = line_height // glyph
+	line_index = np.arange(rows) // (2 * line_rows)
+	in_text = (np.arange(rows) % (2 * line_rows) < line_rows) & \
+		(np.arange(rows) > rows * 0.06) & (np.arange(rows) < rows * 0.94)
+	in_column = (np.arange(cols) > cols * 0.08) & (np.arange(cols) < cols * 0.92)
+	spaces = rng.random((line_index[-1] + 1, cols)) < 0.12
+	ink = (rng.random((rows, cols)) < 0.45) & in_text[:, np.newaxis] & in_column & ~spaces[line_index]
+	page = cv2.resize(np.where(ink, 40, 250).astype(np.uint8), (w, h), interpolation=cv2.INTER_NEAREST)
+	thickness = max(w // 1000, 1)
+	cv2.rectangle(page, (w // 20, h // 30), (w - w // 20, h - h // 30), 60, thickness)
+	page = cv2.GaussianBlur(page, (3, 3), 0)
+	return cv2.cvtColor(page, cv2.COLOR_GRAY2RGB)
+
+def true_source_points(w, h, xs, ys):
+	# the known distortion, from points in the first image to points in the second: a slight
+	# rotation and scaling about the centre, and a bend
+	angle, scale, bend = 0.01, 0.98, 0.004 * w
+	dx, dy = xs - w / 2, ys - h / 2
+	xs2 = w / 2 + scale * (math.cos(angle) * dx - math.sin(angle) * dy) + bend * np.sin(2 * np.pi * ys / h)
+	ys2 = h / 2 + scale * (math.sin(angle) * dx + math.cos(angle) * dy) + bend * np.sin(3 * np.pi * xs / w)
+	return xs2, ys2
+
+def document_pair(megapixels, seed=0):
+	# the second image is the page, the first the page as it should look after distorting the second
+	w, h = page_size(megapixels)
+	image2 = document_image(w, h, seed)
+	image1 = np.empty_like(image2)
+	xs = np.arange(w, dtype=np.float64)
+	for y in range(0, h, BAND_ROWS):
+		ys = np.arange(y, min(y + BAND_ROWS, h), dtype=np.float64)
+		map_x, map_y = true_source_points(w, h, xs[np.newaxis, :], ys[:, np.newaxis])
+		image1[y:y+len(ys)] = cv2.remap(image2, np.float32(map_x), np.float32(map_y), cv2.INTER_LINEAR, \
+			borderMode=cv2.BORDER_CONSTANT, borderValue=(250, 250, 250))
+	return image1, image2
+
+def true_point_pairs(w, h, n, seed=0):
+	rng = np.random.default_rng(seed)
+	xs = rng.uniform(0.05 * w, 0.95 * w, n)
+	ys = rng.uniform(0.05 * h, 0.95 * h, n)
+	xs2, ys2 = true_source_points(w, h, xs, ys)
+	point_pairs = list(dict.fromkeys(((round(x2), round(y2)), (round(x), round(y))) \
+		for (x, y, x2, y2) in zip(xs, ys, xs2, ys2)))
+	return complete_point_pairs_size(point_pairs, (w, h), (w, h))
+
+def sample_points(w, h, n, seed=1):
+	# away from the corners, which are added as point pairs that do not follow the distortion
+	rng = np.random.default_rng(seed)
+	return np.stack((rng.uniform(0.1 * w, 0.9 * w, n), rng.uniform(0.1 * h, 0.9 * h, n)), axis=1)
+
+def mapping_error(transform, points, w, h):
+	mapped, outside = transform.undistort_points(points)
+	xs2, ys2 = true_source_points(w, h, points[:, 0], points[:, 1])
+	return float(np.hypot(mapped[~outside, 0] - xs2[~outside], mapped[~outside, 1] - ys2[~outside]).mean())
+
+def peak_memory(f):
+	# of the arrays and Python objects allocated
+	tracemalloc.start()
+	try:
+		start = time.perf_counter()
+		result = f()
+		return result, time.perf_counter() - start, tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+def measure(stage, megapixels, points, repeats, f):
+	# the first run traces memory, which slows down Python code, so that the time is taken
+	# from further runs, unless the first one exhausted the budget
+	result, traced, peak = peak_memory(f)
+	times = []
+	while len(times) < repeats and traced + sum(times) < STAGE_BUDGET:
+		start = time.perf_counter()
+		f()
+		times.append(time.perf_counter() - start)
+	record = {'stage': stage, 'megapixels': megapixels, 'points': points, \
+		'seconds': min(times, default=traced), 'peak_bytes': peak}
+	return record, result
+
+def tiled_image(source, transform, w, h):
+	out = np.zeros((h, w) + source.shape[2:], dtype=source.dtype)
+	for (x, y, target) in render_tiles(source, transform, w, h):
+		out[y:y+target.shape[0], x:x+target.shape[1]] = target
+	return out
+
+def cold_grid_point_pairs(image1, image2):
+	# with an empty feature cache, in memory and on disk
+	with tempfile.TemporaryDirectory() as directory:
+		autoalign.feature_cache = autoalign.FeatureCache(directory)
+		return get_grid_point_pairs(image2, image1)
+
+def bench_pipeline(sizes=PIPELINE_SIZES, counts=PIPELINE_POINTS, repeats=PIPELINE_REPEATS):
+	results = []
+	for megapixels in sizes:
+		image1, image2 = document_pair(megapixels)
+		h, w = image1.shape[:2]
+		samples = sample_points(w, h, POINT_SAMPLES)
+		cache = autoalign.feature_cache
+		record, found = measure('autoalign', megapixels, 0, repeats, \
+			lambda: cold_grid_point_pairs(image1, image2))
+		autoalign.feature_cache = cache
+		found = np.float64(found).reshape(-1, 4)
+		xs2, ys2 = true_source_points(w, h, found[:, 2], found[:, 3])
+		errors = np.hypot(found[:, 0] - xs2, found[:, 1] - ys2)
+		record['found'] = len(found)
+		record['error'] = float(np.median(errors)) if len(found) > 0 else None
+		record['max_error'] = float(errors.max(initial=0))
+		record['wrong'] = int((errors > ALIGN_TOLERANCE).sum())
+		results.append(record)
+		for n in counts:
+			point_pairs = true_point_pairs(w, h, n)
+			record, (triangle_pairs, neighbors) = measure('delaunay', megapixels, n, repeats, \
+				lambda: triangulate(point_pairs))
+			results.append(record)
+			record, _ = measure('merge_triangles', megapixels, n, repeats, \
+				lambda: merge_triangles(triangle_pairs, neighbors))
+			results.append(record)
+			for mode in PIPELINE_MODES:
+				record, transform = measure('compile_' + mode, megapixels, n, repeats, \
+					lambda: CompiledTransform(point_pairs, mode))
+				results.append(record)
+				if mode == 'w':
+					render = lambda: warp_image_approx(image2, transform.tps, w, h)
+				else:
+					render = lambda: distort_image(image2, transform.pairs, w, h, mode == 'b')
+				record, distorted = measure('distort_' + mode, megapixels, n, repeats, render)
+				record['error'] = mapping_error(transform, samples, w, h)
+				results.append(record)
+				if mode != 'w':
+					# tiles are rendered exactly as the whole image
+					record, tiled = measure('tiles_' + mode, megapixels, n, repeats, \
+						lambda: tiled_image(image2, transform, w, h))
+					record['identical'] = bool(np.array_equal(tiled, np.asarray(distorted)))
+					results.append(record)
+				record, _ = measure('points_' + mode, megapixels, n, repeats, \
+					lambda: transform.distort_points(samples))
+				results.append(record)
+	return results
+
+def print_pipeline(results):
+	print('%-16s %10s %8s %10s %10s %10s' % ('stage', 'megapixels', 'points', 'seconds', 'peak MB', 'error'))
+	for r in results:
+		error = '%10.3f' % r['error'] if r.get('error') is not None else '%10s' % '-'
+		print('%-16s %10g %8d %10.4f %10.1f %s' % (r['stage'], r['megapixels'], r['points'], \
+			r['seconds'], r['peak_bytes'] / 1e6, error))
+
+BENCHMARKS = {
+	'bilinear': (bench_bilinear, print_bilinear),
+	'remap': (bench_remap, print_remap),
+	'reference': (bench_reference, print_reference),
+	'maps': (bench_maps, print_maps),
+	'save': (bench_save, print_save),
+	'grid': (bench_grid, print_grid),
+	'merge': (bench_merge, print_merge),
+	'pipeline': (bench_pipeline, print_pipeline),
+}
+
+def environment():
+	return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__, \
+		'machine': platform.machine(), 'processors': os.cpu_count()}
+
+def result_key(result):
+	return tuple((field, result[field]) for field in KEY_FIELDS if field in result)
+
+def durations(result):
+	return {field: value for field, value in result.items() \
+		if field == 'seconds' or field.endswith('_s')}
+
+def regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+	found = []
+	for name, records in results.items():
+		base = {result_key(r): r for r in baseline['results'].get(name, [])}
+		for r in records:
+			if result_key(r) not in base:
+				continue
+			before = durations(base[result_key(r)])
+			for field, seconds in durations(r).items():
+				if field in before and seconds > before[field] * (1 + threshold) and \
+						seconds - before[field] >= MIN_REGRESSION_SECONDS:
+					found.append((name, result_key(r), field, before[field], seconds))
+	return found
+
+def wrong_alignments(results):
+	return [r for r in results.get('pipeline', []) if r.get('wrong', 0) > 0]
+
+def mismatched_tiles(results):
+	return [r for r in results.get('pipeline', []) if r.get('identical') is False]
+
+def differing_references(results):
+	return [r for r in results.get('reference', []) if r['differing'] > REFERENCE_FRACTION]
+
+def print_differing_references(found):
+	for r in found:
+		print('DIFFERENT mode=%s: %.2f%% of pixels more than %d levels from the per-polygon renderer' % \
+			(r['mode'], 100 * r['differing'], REFERENCE_LEVELS))
+
+def mismatched_maps(results):
+	return [r for r in results.get('maps', []) if r['differing'] > 0]
+
+def print_mismatched_maps(found):
+	for r in found:
+		print('MISMATCH mode=%s format=%s: %d pixels of the applied map differ from distorting directly' % \
+			(r['mode'], r['format'], r['differing']))
+
+def different_saves(results):
+	return [r for r in results.get('save', []) if r['result'] == 'different']
+
+def print_different_saves(found):
+	for r in found:
+		print('DIFFERENT %s with %d channels saved as .%s reads back differently' % \
+			(r['type'], r['channels'], r['format']))
+
+def print_mismatched_tiles(found):
+	for r in found:
+		print('MISMATCH %s megapixels=%g points=%d: tiles differ from the whole image' % \
+			(r['stage'], r['megapixels'], r['points']))
+
+def print_wrong_alignments(found):
+	for r in found:
+		print('WRONG %s megapixels=%g: %d of %d points more than %g pixels off, at most %.1f' % \
+			(r['stage'], r['megapixels'], r['wrong'], r['found'], ALIGN_TOLERANCE, r['max_error']))
+
+def print_regressions(found):
+	for (name, key, field, before, after) in found:
+		print('REGRESSION %s %s %s: %.4fs -> %.4fs (%+.0f%%)' % (name, \
+			' '.join('%s=%s' % item for item in key), field, before, after, 100 * (after / before - 1)))
+
+def parse_list(value, kind):
+	return [kind(v) for v in value.split(',')]
+
+if __name__ == '__main__':
+	sizes = PIPELINE_SIZES
+	counts = PIPELINE_POINTS
+	repeats = PIPELINE_REPEATS
+	out_file = None
+	baseline_file = None
+	threshold = REGRESSION_THRESHOLD
+	try:
+		opts, names = getopt(sys.argv[1:], 's:n:r:o:b:t:', \
+			['sizes=', 'points=', 'repeats=', 'output=', 'baseline=', 'threshold='])
+	except GetoptError as err:
+		print(err)
+		sys.exit(1)
+	for opt, val in opts:
+		if opt in ('-s', '--sizes'):
+			sizes = parse_list(val, float)
+		elif opt in ('-n', '--points'):
+			counts = parse_list(val, int)
+		elif opt in ('-r', '--repeats'):
+			repeats = int(val)
+		elif opt in ('-o', '--output'):
+			out_file = val
+		elif opt in ('-b', '--baseline'):
+			baseline_file = val
+		elif opt in ('-t', '--threshold'):
+			threshold = float(val)
+	names = names if len(names) > 0 else list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			print('Benchmarks are: ' + ', '.join(BENCHMARKS))
+			sys.exit(1)
+	results = {}
+	for name in names:
+		bench, report = BENCHMARKS[name]
+		print(name)
+		results[name] = bench(sizes, counts, repeats) if name == 'pipeline' else bench()
+		report(results[name])
+	if out_file is not None:
+		with open(out_file, 'w') as handle:
+			json.dump({'environment': environment(), 'results': results}, handle, indent=1)
+	wrong = wrong_alignments(results)
+	print_wrong_alignments(wrong)
+	mismatched = mismatched_tiles(results)
+	print_mismatched_tiles(mismatched)
+	different = differing_references(results)
+	print_differing_references(different)
+	mismatched += mismatched_maps(results)
+	print_mismatched_maps(mismatched_maps(results))
+	different += different_saves(results)
+	print_different_saves(different_saves(results))
+	if baseline_file is not None:
+		with open(baseline_file) as handle:
+			found = regressions(results, json.load(handle), threshold)
+		print_regressions(found)
+		print('%d regressions against %s' % (len(found), baseline_file))
+		if len(found) > 0:
+			sys.exit(1)
+	if len(wrong) > 0 or len(mismatched) > 0 or len(different) > 0:
+		sys.exit(1)
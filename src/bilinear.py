@@ -151,6 +151,61 @@ class BilinearMap:
 				y_dest3, dtype=np.float32)
 		return np.dstack((x_dest, y_dest))
 
+	def map_points(self, xs, ys, out_x, out_y, buffers):
+		# as map_grid_fast, for 1D arrays of points, in place in reusable buffers
+		n = len(xs)
+		t0, t1, t2, t3 = buffers.floats(n)
+		nonzero = buffers.bools(n)
+		np.multiply(xs, self.Ay, out=t0)
+		np.multiply(ys, self.Ax, out=t1)
+		np.subtract(t0, t1, out=t0)
+		np.add(t0, self.F1v, out=t0)
+		np.multiply(xs, self.By, out=t1)
+		np.multiply(ys, self.Bx, out=t2)
+		np.subtract(t1, t2, out=t1)
+		np.add(t1, self.G1v, out=t1)
+		if self.Ev == 0:
+			np.negative(t1, out=t1)
+			t2.fill(0)
+			np.not_equal(t0, 0, out=nonzero)
+			np.divide(t1, t0, out=t2, where=nonzero)
+		else:
+			np.multiply(t0, t0, out=t2)
+			np.multiply(t1, 4 * self.Ev, out=t1)
+			np.subtract(t2, t1, out=t2)
+			np.maximum(t2, 0, out=t2)
+			np.sqrt(t2, out=t2)
+			np.subtract(t2, t0, out=t2)
+			np.divide(t2, 2 * self.Ev, out=t2)
+		vs = t2
+		us = t3
+		us.fill(0)
+		np.multiply(vs, self.Cy, out=t0)
+		np.subtract(ys, t0, out=t0)
+		np.subtract(t0, self.Dy, out=t0)
+		np.multiply(vs, self.Ay, out=t1)
+		np.add(t1, self.By, out=t1)
+		np.not_equal(t1, 0, out=nonzero)
+		np.divide(t0, t1, out=us, where=nonzero)
+		np.multiply(vs, self.Cx, out=t0)
+		np.subtract(xs, t0, out=t0)
+		np.subtract(t0, self.Dx, out=t0)
+		np.multiply(vs, self.Ax, out=t1)
+		np.add(t1, self.Bx, out=t1)
+		np.not_equal(t1, 0, out=nonzero)
+		np.divide(t0, t1, out=us, where=nonzero)
+		# (1-u)(1-v) p0 + u(1-v) p1 + uv p2 + (1-u)v p3 = p0 + (p1-p0) u + (p3-p0) v + (p0-p1+p2-p3) uv
+		((x0,y0),(x1,y1),(x2,y2),(x3,y3)) = self.quad2
+		np.multiply(us, vs, out=t0)
+		for out, p0, p1, p2, p3 in ((out_x, x0, x1, x2, x3), (out_y, y0, y1, y2, y3)):
+			np.multiply(us, p1-p0, out=out)
+			np.multiply(vs, p3-p0, out=t1)
+			np.add(out, t1, out=out)
+			np.multiply(t0, p0-p1+p2-p3, out=t1)
+			np.add(out, t1, out=out)
+			np.add(out, p0, out=out)
+		return out_x, out_y
+
 	def map_grid_slow(self, grid):
 		h, w, _ = grid.shape
 		grid_dst = np.empty([h, w, 2], dtype=np.float32)
@@ -162,6 +217,65 @@ class BilinearMap:
 				grid_dst[y][x] = np.array([x_dst, y_dst], dtype=np.float32)
 		return grid_dst
 
+COEFFICIENTS = ('Ax', 'Bx', 'Cx', 'Dx', 'Ay', 'By', 'Cy', 'Dy', 'Ev', 'F1v', 'G1v')
+
+def bilinear_table(maps):
+	# per map the coefficients, followed by those of the bilinear interpolation in quad2:
+	# p0 + (p1-p0) u + (p3-p0) v + (p0-p1+p2-p3) uv, for x and for y
+	table = np.empty((len(maps), len(COEFFICIENTS) + 8))
+	for i, bil in enumerate(maps):
+		((x0,y0),(x1,y1),(x2,y2),(x3,y3)) = bil.quad2
+		table[i, :len(COEFFICIENTS)] = [getattr(bil, c) for c in COEFFICIENTS]
+		table[i, len(COEFFICIENTS):] = [x0, x1-x0, x3-x0, x0-x1+x2-x3, y0, y1-y0, y3-y0, y0-y1+y2-y3]
+	return table
+
+def solve_coefficients(xs, ys, Ax, Bx, Cx, Dx, Ay, By, Cy, Dy, Ev, F1v, G1v):
+	# closed form of coefficients, for arrays of points, each with its own map
+	Fv = Ay * xs - Ax * ys + F1v
+	Gv = By * xs - Bx * ys + G1v
+	root = np.sqrt(np.maximum(Fv * Fv - 4 * Ev * Gv, 0))
+	# (-F + root) / (2E) rewritten as -2G / (F + root), which avoids cancellation for small E,
+	# and for E = 0 is -G / F
+	denom = Fv + root
+	with np.errstate(divide='ignore', invalid='ignore'):
+		vs = np.where(denom != 0, -2 * Gv / denom, np.where(Ev != 0, (root - Fv) / (2 * Ev), 0))
+		denom_x = Ax * vs + Bx
+		us = np.where(denom_x != 0, (xs - Cx * vs - Dx) / denom_x, (ys - Cy * vs - Dy) / (Ay * vs + By))
+	return us, vs
+
+def map_bilinear_table(table, indices, xs, ys):
+	# point i is mapped by the map in row indices[i] of the table
+	t = table[indices]
+	n = len(COEFFICIENTS)
+	us, vs = solve_coefficients(np.float64(xs), np.float64(ys), *t[:, :n].T)
+	uvs = us * vs
+	x_dest = t[:, n] + t[:, n+1] * us + t[:, n+2] * vs + t[:, n+3] * uvs
+	y_dest = t[:, n+4] + t[:, n+5] * us + t[:, n+6] * vs + t[:, n+7] * uvs
+	return x_dest, y_dest
+
+class BilinearBuffers:
+	def __init__(self):
+		self.capacity = 0
+
+	def grow(self, n):
+		if n > self.capacity:
+			self.capacity = max(n, 2 * self.capacity)
+			self.float_buffer = np.empty((8, self.capacity), dtype=np.float32)
+			self.bool_buffer = np.empty(self.capacity, dtype=bool)
+
+	def floats(self, n):
+		self.grow(n)
+		return self.float_buffer[:4, :n]
+
+	def points(self, n):
+		# coordinates of n points, and of their images
+		self.grow(n)
+		return self.float_buffer[4:, :n]
+
+	def bools(self, n):
+		self.grow(n)
+		return self.bool_buffer[:n]
+
 def area(quad):
 	# shoelace formula
 	((x0,y0),(x1,y1),(x2,y2),(x3,y3)) = quad
@@ -0,0 +1,52 @@
+import sys
+import time
+import numpy as np
+import cv2
+
+from autoalign import FeatureBackend, DETECTORS, image_to_cv, ratio_matches
+from imagearray import load_image
+
+RATIO = 0.7
+RANSAC_THRESHOLD = 5.0
+
+def compare_pair(im1_cv, im2_cv, backend):
+	start = time.perf_counter()
+	pts1, ds1 = backend.detect(im1_cv)
+	pts2, ds2 = backend.detect(im2_cv)
+	if len(ds1) < 2 or len(ds2) < 2:
+		return time.perf_counter() - start, 0, 0
+	good = ratio_matches(backend.matcher().knnMatch(ds1, ds2, k=2), RATIO)
+	elapsed = time.perf_counter() - start
+	if len(good) < 4:
+		return elapsed, len(good), 0
+	src = np.float32([pts1[m.queryIdx] for m in good]).reshape(-1,1,2)
+	dst = np.float32([pts2[m.trainIdx] for m in good]).reshape(-1,1,2)
+	_, mask = cv2.findHomography(src, dst, cv2.RANSAC, RANSAC_THRESHOLD)
+	inliers = 0 if mask is None else int(mask.sum())
+	return elapsed, len(good), inliers
+
+def compare(image_pairs, backends):
+	reduced = [(image_to_cv(im1)[1], image_to_cv(im2)[1]) for (im1, im2) in image_pairs]
+	print('%-14s %10s %10s %12s %10s' % ('features', 'seconds', 'matches', 'matches/s', 'inliers'))
+	for backend in backends:
+		total_time = 0
+		total_matches = 0
+		total_inliers = 0
+		for im1_cv, im2_cv in reduced:
+			elapsed, matches, inliers = compare_pair(im1_cv, im2_cv, backend)
+			total_time += elapsed
+			total_matches += matches
+			total_inliers += inliers
+		label = backend.name + ('+bf' if backend.bruteforce else '')
+		rate = total_matches / total_time if total_time > 0 else 0
+		ratio = total_inliers / total_matches if total_matches > 0 else 0
+		print('%-14s %10.2f %10d %12.0f %10.3f' % (label, total_time, total_matches, rate, ratio))
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3 or len(sys.argv) % 2 == 0:
+		print('Required are pairs of images')
+		sys.exit(1)
+	files = sys.argv[1:]
+	image_pairs = [(load_image(files[i]), load_image(files[i+1])) for i in range(0, len(files), 2)]
+	backends = [FeatureBackend(name, bruteforce) for name in DETECTORS for bruteforce in (False, True)]
+	compare(image_pairs, backends)
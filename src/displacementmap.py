@@ -0,0 +1,286 @@
+import sys
+import os
+import json
+import numpy as np
+import cv2
+from getopt import getopt, GetoptError
+from PIL import Image
+
+from imagedistortion import CompiledTransform, polygon_labels, polygon_source_maps, linear_labels, \
+		get_grid, complete_point_pairs_size, read_point_pairs
+from tiledrender import TILE_SIZE, tile_rects, read_window, read_padded_window, source_window, \
+		remap_window
+from imagearray import load_image, save_image, image_size
+
+# a displacement map stores per pixel of the distorted image the offset to the pixel of the
+# source it is sampled from, as (dx, dy); pixels outside all polygons have none
+FORMATS = ['float32', 'float16', 'int16', 'lattice']
+# int16 stores displacements in units of 1/32 pixel, the precision at which cv2.remap samples
+FIXED_POINT_SCALE = 32
+INT16_OUTSIDE = -32768
+LATTICE_MIN_STEP = 4
+LATTICE_MAX_STEP = 64
+LATTICE_TOLERANCE = 0.25
+BAND_ROWS = 256
+# far enough beyond the source that all taps of interpolation fall in the black border
+OUTSIDE_COORD = -10000.0
+INTERPOLATIONS = {'cubic': cv2.INTER_CUBIC, 'linear': cv2.INTER_LINEAR}
+
+def meta_path(path):
+	return os.path.splitext(path)[0] + '.json'
+
+def linear_path(path):
+	return os.path.splitext(path)[0] + '.linear.npy'
+
+def tile_displacement(transform, x, y, w, h):
+	if transform.poly_mode == 'w':
+		grid = get_grid(w, h) + np.float32([x, y])
+		grid_warped = transform.tps.applyTransformation(grid.reshape(1, -1, 2))[1].reshape(h, w, 2)
+	else:
+		labels = polygon_labels(transform.pairs, x, y, w, h)
+		map_x, map_y = polygon_source_maps(transform.pairs, labels, x, y, transform.poly_mode == 'b')
+		grid_warped = np.dstack((map_x, map_y))
+		grid_warped[labels == 0] = np.nan
+	return grid_warped - get_grid(w, h) - np.float32([x, y])
+
+def export_linear(transform, w, h, path, tile):
+	# the pixels of quadrilaterals in perspective, which distort_image interpolates linearly, or
+	# False if there are none
+	if transform.poly_mode != 'q' or all(len(t1) == 3 for (t1, _) in transform.pairs):
+		return False
+	linear = np.lib.format.open_memmap(path, mode='w+', dtype=np.bool_, shape=(h, w))
+	for (x, y, w_tile, h_tile) in tile_rects(w, h, tile):
+		labels = polygon_labels(transform.pairs, x, y, w_tile, h_tile)
+		linear[y:y+h_tile, x:x+w_tile] = linear_labels(transform.pairs, labels, False)
+	linear.flush()
+	del linear
+	return True
+
+def encode(displacement, fmt):
+	if fmt == 'float16':
+		return displacement.astype(np.float16)
+	if fmt == 'int16':
+		scaled = displacement * FIXED_POINT_SCALE
+		outside = np.isnan(scaled)
+		if np.abs(scaled[~outside]).max(initial=0) > np.iinfo(np.int16).max:
+			raise ValueError('Displacements beyond %d pixels need format float32 or float16' % \
+				(np.iinfo(np.int16).max // FIXED_POINT_SCALE))
+		return np.where(outside, INT16_OUTSIDE, np.round(scaled)).astype(np.int16)
+	return displacement
+
+def decode(stored, fmt):
+	if fmt == 'int16':
+		displacement = stored.astype(np.float32) / FIXED_POINT_SCALE
+		displacement[stored == INT16_OUTSIDE] = np.nan
+		return displacement
+	return stored.astype(np.float32)
+
+def max_error(approx, exact):
+	# over the pixels that are inside in both
+	both = ~np.isnan(approx) & ~np.isnan(exact)
+	return float(np.abs(approx[both] - exact[both]).max(initial=0))
+
+def lattice_coords(n, step):
+	# multiples of step, and the last pixel
+	return np.unique(np.minimum(np.arange(0, n - 1 + step, step), n - 1))
+
+def lattice_weights(coords, points):
+	i = np.clip(np.searchsorted(coords, points, 'right') - 1, 0, max(len(coords) - 2, 0))
+	j = np.minimum(i + 1, len(coords) - 1)
+	span = coords[j] - coords[i]
+	t = np.where(span > 0, (points - coords[i]) / np.maximum(span, 1), 0).astype(np.float32)
+	return i, j, t
+
+def interpolate_lattice(lattice, step, size, x, y, w, h):
+	# bilinear interpolation between lattice points, which lie on pixels
+	w_map, h_map = size
+	ix0, ix1, tx = lattice_weights(lattice_coords(w_map, step), np.arange(x, x + w))
+	iy0, iy1, ty = lattice_weights(lattice_coords(h_map, step), np.arange(y, y + h))
+	tx = tx[np.newaxis, :, np.newaxis]
+	ty = ty[:, np.newaxis, np.newaxis]
+	top = lattice[iy0][:, ix0] * (1 - tx) + lattice[iy0][:, ix1] * tx
+	bottom = lattice[iy1][:, ix0] * (1 - tx) + lattice[iy1][:, ix1] * tx
+	return top * (1 - ty) + bottom * ty
+
+def lattice_steps():
+	step = LATTICE_MAX_STEP
+	while step >= LATTICE_MIN_STEP:
+		yield step
+		step //= 2
+
+def export_lattice(transform, w, h, tolerance, tile):
+	# lattice of the finest step, of which those of coarser steps are subsets
+	xs = lattice_coords(w, LATTICE_MIN_STEP)
+	ys = lattice_coords(h, LATTICE_MIN_STEP)
+	fine = np.full((len(ys), len(xs), 2), np.nan, dtype=np.float32)
+	for (x, y, w_tile, h_tile) in tile_rects(w, h, tile):
+		displacement = tile_displacement(transform, x, y, w_tile, h_tile)
+		cols = np.nonzero((xs >= x) & (xs < x + w_tile))[0]
+		rows = np.nonzero((ys >= y) & (ys < y + h_tile))[0]
+		fine[np.ix_(rows, cols)] = displacement[ys[rows] - y][:, xs[cols] - x]
+	lattices = {}
+	for step in lattice_steps():
+		cols = np.searchsorted(xs, lattice_coords(w, step))
+		rows = np.searchsorted(ys, lattice_coords(h, step))
+		lattices[step] = fine[np.ix_(rows, cols)]
+	errors = dict.fromkeys(lattices, 0.0)
+	for (x, y, w_tile, h_tile) in tile_rects(w, h, tile):
+		displacement = tile_displacement(transform, x, y, w_tile, h_tile)
+		for step, lattice in lattices.items():
+			approx = interpolate_lattice(lattice, step, (w, h), x, y, w_tile, h_tile)
+			errors[step] = max(errors[step], max_error(approx, displacement))
+	# the coarsest lattice within tolerance, or else the finest
+	step = next((s for s in lattice_steps() if errors[s] <= tolerance), LATTICE_MIN_STEP)
+	return lattices[step], step, errors[step]
+
+def export_map(transform, size, source_size, path, fmt='int16', tolerance=LATTICE_TOLERANCE, tile=TILE_SIZE):
+	w, h = size
+	w_source, h_source = source_size
+	meta = {'format': fmt, 'mode': transform.poly_mode, 'width': w, 'height': h, \
+		'source_width': w_source, 'source_height': h_source, 'step': 1, 'scale': 1}
+	if transform.poly_mode == 'w':
+		# as warp_image_grid, white up to the padded size and black beyond
+		meta['interpolation'] = 'linear'
+		meta['padded_width'] = max(w, w_source)
+		meta['padded_height'] = max(h, h_source)
+	else:
+		meta['interpolation'] = 'cubic'
+	if export_linear(transform, w, h, linear_path(path), tile):
+		meta['linear'] = os.path.basename(linear_path(path))
+	if fmt == 'lattice':
+		lattice, step, error = export_lattice(transform, w, h, tolerance, tile)
+		np.save(path, lattice)
+		meta['step'] = step
+	else:
+		if fmt == 'int16':
+			meta['scale'] = FIXED_POINT_SCALE
+		dtype = encode(np.zeros((1, 1, 2), dtype=np.float32), fmt).dtype
+		out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(h, w, 2))
+		error = 0.0
+		for (x, y, w_tile, h_tile) in tile_rects(w, h, tile):
+			displacement = tile_displacement(transform, x, y, w_tile, h_tile)
+			stored = encode(displacement, fmt)
+			error = max(error, max_error(decode(stored, fmt), displacement))
+			out[y:y+h_tile, x:x+w_tile] = stored
+		out.flush()
+		del out
+	meta['error'] = error
+	with open(meta_path(path), 'w') as handle:
+		json.dump(meta, handle, indent=1)
+	return meta
+
+class DisplacementMap:
+	def __init__(self, path):
+		with open(meta_path(path)) as handle:
+			self.meta = json.load(handle)
+		self.stored = np.load(path, mmap_mode='r')
+		self.size = (self.meta['width'], self.meta['height'])
+		self.source_size = (self.meta['source_width'], self.meta['source_height'])
+		self.interpolation = INTERPOLATIONS[self.meta['interpolation']]
+		self.linear = None
+		if 'linear' in self.meta:
+			self.linear = np.load(os.path.join(os.path.dirname(path), self.meta['linear']), mmap_mode='r')
+
+	def displacement(self, x, y, w, h):
+		fmt = self.meta['format']
+		if fmt == 'lattice':
+			return interpolate_lattice(self.stored, self.meta['step'], self.size, x, y, w, h)
+		return decode(self.stored[y:y+h, x:x+w], fmt)
+
+	def source_maps(self, x, y, w, h):
+		grid_warped = self.displacement(x, y, w, h) + get_grid(w, h) + np.float32([x, y])
+		inside = ~np.isnan(grid_warped).any(axis=2)
+		grid_warped[~inside] = OUTSIDE_COORD
+		return np.ascontiguousarray(grid_warped[:, :, 0]), np.ascontiguousarray(grid_warped[:, :, 1]), inside
+
+	def render_band(self, source, y, h, target):
+		w = self.size[0]
+		map_x, map_y, inside = self.source_maps(0, y, w, h)
+		if 'padded_width' in self.meta:
+			limits = (self.meta['padded_width'], self.meta['padded_height'])
+		else:
+			limits = image_size(source)
+		window = source_window(map_x, map_y, inside, limits[0], limits[1])
+		target[:] = 0
+		if window is None:
+			return
+		x0, y0, x1, y1 = window
+		if 'padded_width' in self.meta:
+			window = read_padded_window(source, x0, y0, x1, y1, target.shape[2:], target.dtype)
+		else:
+			window = read_window(source, x0, y0, x1, y1)
+		target[:] = remap_window(window, map_x, map_y, x0, y0, self.interpolation)
+		if self.linear is not None:
+			# as in tiled rendering
+			linear = self.linear[y:y+h] & inside
+			if linear.any():
+				remapped = remap_window(window, map_x, map_y, x0, y0, cv2.INTER_LINEAR)
+				target[linear] = remapped[linear]
+
+	def apply(self, source, target):
+		if image_size(source) != self.source_size:
+			raise ValueError('Image is %dx%d, the map is for images of %dx%d' % \
+				(image_size(source) + self.source_size))
+		for y in range(0, self.size[1], BAND_ROWS):
+			h = min(BAND_ROWS, self.size[1] - y)
+			self.render_band(source, y, h, target[y:y+h])
+
+def apply_map(displacement_map, in_file, out_file):
+	source = load_image(in_file)
+	w, h = displacement_map.size
+	shape = (h, w) + source.shape[2:]
+	if out_file.lower().endswith('.npy'):
+		target = np.lib.format.open_memmap(out_file, mode='w+', dtype=source.dtype, shape=shape)
+		displacement_map.apply(source, target)
+		target.flush()
+	else:
+		target = np.zeros(shape, dtype=source.dtype)
+		displacement_map.apply(source, target)
+		save_image(target, out_file)
+
+def usage():
+	print('Required is either:')
+	print('  export image1 image2 pointpairs map.npy')
+	print('  apply map.npy input output [input output ...]')
+	sys.exit(1)
+
+if __name__ == '__main__':
+	poly_mode = 't'
+	fmt = 'int16'
+	tolerance = LATTICE_TOLERANCE
+	try:
+		opts, vals = getopt(sys.argv[1:], 'm:f:t:', ['mode=', 'format=', 'tolerance='])
+	except GetoptError as err:
+		print(err)
+		sys.exit(1)
+	for opt, val in opts:
+		if opt in ('-m', '--mode'):
+			poly_mode = val
+		elif opt in ('-f', '--format'):
+			fmt = val
+		elif opt in ('-t', '--tolerance'):
+			tolerance = float(val)
+	if poly_mode not in ['t', 'q', 'b', 'w']:
+		print('Mode must be one of: t, q, b, w')
+		sys.exit(1)
+	if fmt not in FORMATS:
+		print('Format must be one of: ' + ', '.join(FORMATS))
+		sys.exit(1)
+	if len(vals) == 5 and vals[0] == 'export':
+		# only the sizes of the images are needed
+		size1 = Image.open(vals[1]).size
+		size2 = Image.open(vals[2]).size
+		point_pairs = complete_point_pairs_size(read_point_pairs(vals[3]), size1, size2)
+		transform = CompiledTransform(point_pairs, poly_mode)
+		meta = export_map(transform, size1, size2, vals[4], fmt, tolerance)
+		print('%s map of %dx%d, step %d, maximum error %.4f pixels' % \
+			(fmt, meta['width'], meta['height'], meta['step'], meta['error']))
+		if fmt == 'lattice' and meta['error'] > tolerance:
+			print('Tolerance not reached; the map has kinks or jumps between polygons, consider int16')
+	elif len(vals) >= 4 and len(vals) % 2 == 0 and vals[0] == 'apply':
+		displacement_map = DisplacementMap(vals[1])
+		for in_file, out_file in zip(vals[2::2], vals[3::2]):
+			apply_map(displacement_map, in_file, out_file)
+			print(out_file)
+	else:
+		usage()
@@ -2,17 +2,30 @@ import csv
 import os
 import sys
 import math
+import time
 import webbrowser
 import tkinter as tk
+from tkinter import messagebox
+import numpy as np
 from getopt import getopt, GetoptError
-from PIL import Image, ImageTk
-
-from imagedistortion import point_pairs_to_triangle_pairs, split_point_pairs, \
-		distort_image, undistort_point, warp_image, unwarp_point, \
-		read_point_pairs, write_point_pairs, merge_triangles
-from autoalign import get_corner_point_pairs, get_grid_point_pairs
+from PIL import Image, ImageTk, ImageChops
+from scipy.spatial import cKDTree
+
+from imagedistortion import CompiledTransform, IncrementalDistortion, ViewDistortion, \
+		warp_image_tps, warp_image_approx, complete_point_pairs_size, \
+		read_point_pairs, write_point_pairs
+from autoalign import get_corner_point_pairs, get_grid_point_pairs, FeatureBackend, DETECTORS, \
+		GRID_SIZE
+from renderworker import RenderWorker
+from pyramid import ImagePyramid, LRUCache
+from imagearray import display_image, save_image
+from imageloader import ImageLoader
+from timing import timing
 
 DELAY = 1
+POLL_DELAY = 20
+LOAD_POLL_DELAY = 100
+PHOTO_CACHE_SIZE = 16
 KEY_ZOOM_STEP = 1.2
 MOUSE_ZOOM_STEP = 1.1
 MIN_PIXELS_IN_CANVAS = 10
@@ -24,30 +37,11 @@ CIRC = 5
 POINT_COLOR = 'red'
 ARROW_COLOR = 'red'
 DRAGGED_COLOR = 'gray'
-
-def complete_point_pairs(point_pairs, image1, image2):
-	w1, h1 = image1.size
-	w2, h2 = image2.size
-	top_left1 = (0, 0)
-	top_left2 = (0, 0)
-	top_right1 = (w1-1, 0)
-	top_right2 = (w2-1, 0)
-	bottom_left1 = (0, h1-1)
-	bottom_left2 = (0, h2-1)
-	bottom_right1 = (w1-1, h1-1)
-	bottom_right2 = (w2-1, h2-1)
-	points1 = [p1 for (_,p1) in point_pairs]
-	points2 = [p2 for (p2,_) in point_pairs]
-	completed = point_pairs[:]
-	if top_left1 not in points1 and top_left2 not in points2:
-		completed.append((top_left2, top_left1))
-	if top_right1 not in points1 and top_right2 not in points2:
-		completed.append((top_right2, top_right1))
-	if bottom_left1 not in points1 and bottom_left2 not in points2:
-		completed.append((bottom_left2, bottom_left1))
-	if bottom_right1 not in points1 and bottom_right2 not in points2:
-		completed.append((bottom_right2, bottom_right1))
-	return completed
+# views of both images, composed from the visible parts at the resolution of the canvas
+COMPARE_VIEWS = ['both', 'difference', 'checkerboard']
+BLEND_ALPHA = 0.5
+ALPHA_STEP = 0.1
+CHECKER_SIZE = 32
 
 class AlignImageMenu(tk.Menu):
 	def __init__(self, parent, item_set):
@@ -59,6 +53,60 @@ class AlignImageMenu(tk.Menu):
 				submenu.add_command(label=sublabel, command=command, accelerator=acc_display)
 			self.add_cascade(label=label, menu=submenu)
 
+def checkerboard_mask(size):
+	w, h = size
+	xs = np.arange(w) // CHECKER_SIZE
+	ys = np.arange(h) // CHECKER_SIZE
+	return Image.fromarray(np.uint8((xs[np.newaxis, :] + ys[:, np.newaxis]) % 2 * 255))
+
+def compare_views(view1, view2, mode, alpha=BLEND_ALPHA):
+	if mode == 'difference':
+		return ImageChops.difference(view1, view2)
+	if mode == 'checkerboard':
+		return Image.composite(view1, view2, checkerboard_mask(view1.size))
+	return Image.blend(view1, view2, alpha)
+
+class PointIndex:
+	def __init__(self, points):
+		# the points in image 1
+		self.points = np.float64(points).reshape(-1, 2)
+		self.tree = cKDTree(self.points) if len(self.points) > 0 else None
+
+	def nearest(self, x, y):
+		if self.tree is None:
+			return -1, math.inf
+		d, i = self.tree.query((x, y))
+		return int(i), d
+
+	def inside(self, x_min, y_min, x_max, y_max):
+		xs = self.points[:, 0]
+		ys = self.points[:, 1]
+		return np.nonzero((xs >= x_min) & (xs <= x_max) & (ys >= y_min) & (ys <= y_max))[0]
+
+class PointMarkers:
+	def __init__(self, canvas):
+		# ovals are kept between redraws, and hidden when not needed
+		self.canvas = canvas
+		self.items = []
+		self.colors = []
+		self.shown = 0
+
+	def show(self, markers):
+		for k, (x, y, color) in enumerate(markers):
+			if k == len(self.items):
+				self.items.append(self.canvas.create_oval(0, 0, 0, 0, outline=color, width=2))
+				self.colors.append(color)
+			item = self.items[k]
+			self.canvas.coords(item, MARGIN+x-CIRC, MARGIN+y-CIRC, MARGIN+x+CIRC, MARGIN+y+CIRC)
+			if self.colors[k] != color:
+				self.canvas.itemconfig(item, outline=color)
+				self.colors[k] = color
+			if k >= self.shown:
+				self.canvas.itemconfig(item, state=tk.NORMAL)
+		for item in self.items[len(markers):self.shown]:
+			self.canvas.itemconfig(item, state=tk.HIDDEN)
+		self.shown = len(markers)
+
 class AlignImage(tk.Frame):
 	def __init__(self, root):
 		self.root = root
@@ -81,7 +129,9 @@ class AlignImage(tk.Frame):
 		items.append(('Tools', 
 			[('View 1', self.view1, '1', '1'),
 				('View 2', self.view2, '2', '2'),
-				('View both', self.view_both, '3', '3')]))
+				('View both', self.view_both, '3', '3'),
+				('View difference', self.view_difference, '4', '4'),
+				('View checkerboard', self.view_checkerboard, '5', '5')]))
 		if sys.platform == 'darwin':
 			items.append(('View', 
 				[('Maximize', self.maximize, '<Meta-Control-f>', 'Command+Ctrl+F'),
@@ -92,6 +142,7 @@ class AlignImage(tk.Frame):
 					('Default view', self.default_view, '<F5>', 'F5')]))
 		self.menu = AlignImageMenu(self, items)
 		self.add_polygon_control()
+		self.add_feature_control()
 		self.add_help()
 		self.menu_empty = tk.Menu(self.master)
 
@@ -108,6 +159,15 @@ class AlignImage(tk.Frame):
 			command=self.set_warp)
 		self.menu.add_cascade(label='Polygons', menu=self.poly_menu)
 
+	def add_feature_control(self):
+		self.features_var = tk.StringVar(self.master, 'sift')
+		self.features_menu = tk.Menu(self.menu, tearoff=False)
+		self.features_menu.add_radiobutton(label='SIFT', var=self.features_var, value='sift')
+		self.features_menu.add_radiobutton(label='ORB', var=self.features_var, value='orb')
+		self.features_menu.add_radiobutton(label='AKAZE', var=self.features_var, value='akaze')
+		self.features_menu.add_radiobutton(label='BRISK', var=self.features_var, value='brisk')
+		self.menu.add_cascade(label='Features', menu=self.features_menu)
+
 	def add_help(self):
 		self.menu.add_command(label='Help', command=self.show_help)
 
@@ -129,14 +189,32 @@ class AlignImage(tk.Frame):
 		self.master.bind('<Right>', lambda event: self.right())
 		self.master.bind('<Up>', lambda event: self.up())
 		self.master.bind('<Down>', lambda event: self.down())
+		# with timing enabled, a status line shows the breakdown of the last rendering
+		self.status = None
+		self.timed_kind = None
+		self.failed_render = None
+		if timing.enabled:
+			self.status = tk.Label(self.master, anchor=tk.W)
+			self.status.pack(side=tk.BOTTOM, fill=tk.X)
 		self.canvas = tk.Canvas(self.master, bg='gray')
 		self.canvas.pack(fill=tk.BOTH, expand=True)
 		self.canvas.bind('<Motion>', lambda event: self.motion_canvas())
 		self.canvas.bind('<Leave>', lambda event: self.abort_drag())
+		self.image_item = None
+		self.markers = PointMarkers(self.canvas)
 		self.drag_start = None
 		self.mode = 'move'
-		self.image1 = None
+		self.loader1 = None
+		self.transform = None
+		self.multiscale = False
+		self.bruteforce = False
+		self.grid_size = GRID_SIZE
 		self.timer = None
+		self.im = None
+		self.worker = RenderWorker()
+		self.polling = False
+		# for reporting the time to the first image shown
+		self.start_time = None
 		self.default_view()
 
 	def default_view(self):
@@ -159,46 +237,187 @@ class AlignImage(tk.Frame):
 		self.quit()
 
 	def set_images(self, image1, image2, point_pairs):
-		self.image1 = image1.convert('RGB')
-		self.image2 = image2.convert('RGB')
-		self.w_image1, self.h_image1 = self.image1.size
-		self.w_image2, self.h_image2 = self.image2.size
+		# images, or loaders of which the reduced images are shown until the full ones are loaded;
+		# rendering is from the images as they are, the canvas shows them in 8-bit RGB
+		self.loader1 = image1 if isinstance(image1, ImageLoader) else ImageLoader.of_image(image1)
+		self.loader2 = image2 if isinstance(image2, ImageLoader) else ImageLoader.of_image(image2)
+		self.image1 = None
+		self.image2 = None
+		self.w_image1, self.h_image1 = self.loader1.size
+		self.w_image2, self.h_image2 = self.loader2.size
 		self.point_pairs = point_pairs
 		self.normalize_point_pairs()
+		self.view_distortion = ViewDistortion(self.loader2.reduced, self.loader2.factor, self.loader2.size)
+		self.pyramid1 = ImagePyramid(display_image(self.loader1.reduced), self.loader1.factor)
+		# photo images are keyed by the generation of the displayed images
+		self.photos = LRUCache(PHOTO_CACHE_SIZE)
+		self.generation = 0
+		self.set_full(None, 0, None, None)
+		self.preview = None
+		self.preview_key = None
 		self.view_mode = 'both'
+		self.alpha = BLEND_ALPHA
 		self.set_distorted()
 		self.scale = 0.000001
 		self.center = (0.5, 0.5)
 		self.adjust_zoom()
+		self.loader1.start()
+		self.loader2.start()
+		self.poll_load()
+
+	def poll_load(self):
+		if self.image1 is not None:
+			return
+		if self.loader1.done() and self.loader2.done():
+			self.set_loaded()
+		else:
+			self.root.after(LOAD_POLL_DELAY, self.poll_load)
+
+	def set_loaded(self):
+		# full resolution, needed for rendering at 1:1 or more, for saving and for finding points
+		self.image1 = self.loader1.full()
+		self.image2 = self.loader2.full()
+		self.distortion = IncrementalDistortion(self.image2, self.w_image1, self.h_image1)
+		if self.loader2.factor > 1:
+			self.view_distortion = ViewDistortion(self.image2)
+			self.preview_key = None
+		if self.loader1.factor > 1:
+			self.pyramid1 = ImagePyramid(display_image(self.image1))
+			self.photos.clear()
+		self.generation += 1
+		self.delayed_redraw()
+
+	def wait_loaded(self):
+		if self.image1 is None:
+			self.show_wait()
+			try:
+				self.set_loaded()
+			finally:
+				self.normal_cursor()
 
 	def normalize_point_pairs(self):
-		self.point_pairs = complete_point_pairs(self.point_pairs, self.image1, self.image2)
+		self.point_pairs = complete_point_pairs_size(self.point_pairs, (self.w_image1, self.h_image1), \
+			(self.w_image2, self.h_image2))
 
 	def set_distorted(self):
-		self.show_wait()
-		if self.poly_mode_var.get() == 'w':
-			pts_dst, pts_src, matches = split_point_pairs(self.point_pairs)
-			self.distorted = warp_image(self.image2, pts_src, pts_dst, matches, \
+		# rendered in the background when displayed, or when saved; this follows every change
+		# of the point pairs, so that the index of the points is rebuilt when next needed
+		self.index = None
+		self.delayed_redraw()
+
+	def point_index(self):
+		if self.index is None:
+			self.index = PointIndex([p for (_, p) in self.point_pairs])
+		return self.index
+
+	def render_full(self, transform):
+		if transform.poly_mode == 'w':
+			distorted, warp_error = warp_image_approx(self.image2, transform.tps, \
 				self.w_image1, self.h_image1)
 		else:
-			pairs = point_pairs_to_triangle_pairs(self.point_pairs)
-			if self.poly_mode_var.get() == 'q' or self.poly_mode_var.get() == 'b':
-				pairs = merge_triangles(pairs)
-			self.distorted = distort_image(self.image2, pairs, self.w_image1, self.h_image1, 
-				self.poly_mode_var.get() == 'b')
-		self.normal_cursor()
-		self.merged = Image.blend(self.image1, self.distorted, 0.5)
-		self.delayed_redraw()
+			distorted = self.distortion.distort(transform.pairs, transform.poly_mode == 'b')
+			warp_error = 0
+		return distorted, warp_error, self.displayed(distorted)
+
+	def render_exact(self, transform):
+		if transform.poly_mode == 'w':
+			distorted = warp_image_tps(self.image2, transform.tps, self.w_image1, self.h_image1)
+		else:
+			distorted = self.distortion.distort(transform.pairs, transform.poly_mode == 'b')
+		return distorted, 0, self.displayed(distorted)
+
+	def displayed(self, distorted):
+		with timing.stage('display'):
+			return display_image(distorted)
+
+	def render_preview(self, transform, rect, w, h):
+		return display_image(self.view_distortion.distort(transform, rect, w, h, \
+			self.w_image1, self.h_image1))
+
+	def set_full(self, distorted, warp_error, shown, transform):
+		self.distorted = distorted
+		self.warp_error = warp_error
+		self.distorted_transform = transform
+		if distorted is None:
+			self.distorted_pyramid = None
+		else:
+			self.distorted_pyramid = ImagePyramid(shown)
+		self.generation += 1
+
+	def exact_distorted(self):
+		transform = self.compiled_transform()
+		if self.distorted_transform is not transform or self.warp_error > 0:
+			self.wait_loaded()
+			self.show_wait()
+			distorted, warp_error, shown = self.worker.run_now( \
+				lambda: timing.collected('exact', lambda: self.render_exact(transform)))
+			self.timed_kind = 'exact'
+			self.set_full(distorted, warp_error, shown, transform)
+			self.normal_cursor()
+		return self.distorted
+
+	def request_render(self, kind, key, render):
+		self.worker.submit(kind, key, lambda: timing.collected(kind, render))
+		if not self.polling:
+			self.polling = True
+			self.root.after(POLL_DELAY, self.poll_render)
+
+	def poll_render(self):
+		for kind, key, result, error in self.worker.finished():
+			self.timed_kind = kind
+			if error is not None:
+				self.render_failed(kind, key, error)
+				continue
+			if kind == 'full':
+				distorted, warp_error, shown = result
+				self.set_full(distorted, warp_error, shown, key)
+			elif kind == 'preview':
+				self.preview = result
+				self.preview_key = key
+				self.generation += 1
+			self.delayed_redraw()
+		if self.worker.busy():
+			self.root.after(POLL_DELAY, self.poll_render)
+		else:
+			self.polling = False
+
+	def render_failed(self, kind, key, error):
+		# tried again on the next redraw, rather than in a loop, and reported once
+		self.worker.forget(kind, key)
+		if self.failed_render != (kind, key):
+			self.failed_render = (kind, key)
+			messagebox.showerror('Rendering failed', error.strip().splitlines()[-1])
+
+	def compiled_transform(self):
+		if self.transform is None or \
+				not self.transform.is_compiled_for(self.point_pairs, self.poly_mode_var.get()):
+			self.transform = CompiledTransform(self.point_pairs, self.poly_mode_var.get())
+		return self.transform
+
+	def feature_backend(self):
+		return FeatureBackend(self.features_var.get(), self.bruteforce)
 
 	def add_auto(self):
+		self.wait_loaded()
 		self.show_wait()
-		self.point_pairs = get_grid_point_pairs(self.image2, self.image1)
+		try:
+			self.point_pairs = timing.collected('autoalign', lambda: get_grid_point_pairs(self.image2, \
+				self.image1, self.multiscale, self.feature_backend(), self.grid_size))
+		finally:
+			self.normal_cursor()
+		self.timed_kind = 'autoalign'
 		self.normalize_point_pairs()
 		self.set_distorted()
 
 	def add_auto_four(self):
+		self.wait_loaded()
 		self.show_wait()
-		self.point_pairs = get_corner_point_pairs(self.image2, self.image1)
+		try:
+			self.point_pairs = timing.collected('autoalign', lambda: get_corner_point_pairs(self.image2, \
+				self.image1, self.multiscale, self.feature_backend()))
+		finally:
+			self.normal_cursor()
+		self.timed_kind = 'autoalign'
 		self.normalize_point_pairs()
 		self.set_distorted()
 
@@ -214,6 +433,19 @@ class AlignImage(tk.Frame):
 		self.view_mode = 'both'
 		self.delayed_redraw()
 
+	def view_difference(self):
+		self.view_mode = 'difference'
+		self.delayed_redraw()
+
+	def view_checkerboard(self):
+		self.view_mode = 'checkerboard'
+		self.delayed_redraw()
+
+	def change_alpha(self, step):
+		# of the second image in the superimposed view
+		self.alpha = round(min(max(self.alpha + step, 0), 1), 2)
+		self.view_both()
+
 	def set_triangles(self):
 		self.poly_mode_var.set('t')
 		self.set_distorted()
@@ -245,40 +477,100 @@ class AlignImage(tk.Frame):
 
 	def redraw(self):
 		self.timer = None
-		if self.image1 is None:
+		timing.collected('redraw', self.draw_canvas)
+		self.show_timing()
+
+	def show_timing(self):
+		if self.status is None:
+			return
+		summaries = [timing.summary(self.timed_kind), timing.summary('redraw')]
+		self.status.config(text=' | '.join([s for s in summaries if s != '']))
+
+	def draw_canvas(self):
+		if self.loader1 is None:
 			return
 		x_min, y_min, w, h = self.visible_rect()
-		x_max = x_min + w
-		y_max = y_min + h
+		if w < 1 or h < 1 or self.w_canvas < 1 or self.h_canvas < 1:
+			return
+		photo = self.view_photo((x_min, y_min, w, h))
+		if photo is not None:
+			self.im = photo # attach to self to avoid garbage collection
+		self.canvas.delete('arrow')
+		if self.im is not None:
+			if self.image_item is None:
+				self.image_item = self.canvas.create_image(MARGIN, MARGIN, anchor=tk.NW, image=self.im)
+				# below the point markers, which may have been drawn before the first image
+				self.canvas.tag_lower(self.image_item)
+			else:
+				self.canvas.itemconfig(self.image_item, image=self.im)
+			if self.start_time is not None and timing.enabled:
+				timing.record('first_frame', time.perf_counter() - self.start_time)
+			self.start_time = None
+		self.draw_points()
+
+	def view_photo(self, rect):
+		x_min, y_min, w, h = rect
+		box = (x_min, y_min, x_min + w, y_min + h)
+		size = (self.w_canvas, self.h_canvas)
 		if self.view_mode == '1':
-			im = self.image1
-		elif self.view_mode == '2':
-			im = self.distorted
+			return self.photos.get(('1', rect, size), \
+				lambda: ImageTk.PhotoImage(self.pyramid1.crop_resized(box, size)))
+		transform = self.compiled_transform()
+		key = (self.view_mode, self.alpha, self.generation, rect, size)
+		if self.scale >= 1 and self.image2 is not None:
+			if self.distorted_transform is not transform:
+				self.request_render('full', transform, lambda: self.render_full(transform))
+			# until the new rendering arrives the previous one is shown
+			if self.distorted is None:
+				return None
+			return self.photos.get(key, lambda: ImageTk.PhotoImage( \
+				self.view_shown(box, size, self.distorted_pyramid.crop_resized(box, size))))
 		else:
-			im = self.merged
-		cropped = im.crop((x_min, y_min, x_max, y_max))
-		resized = cropped.resize((self.w_canvas, self.h_canvas))
-		self.im = ImageTk.PhotoImage(resized) # attach to self to avoid garbage collection
-		self.canvas.delete('all')
-		self.canvas.create_image(MARGIN, MARGIN, anchor=tk.NW, image=self.im)
-		self.draw_points()
+			# below 1:1, or while the full images are loaded, only the visible part is rendered,
+			# at the resolution of the canvas
+			preview_key = (transform, rect, size)
+			if self.preview_key != preview_key:
+				self.request_render('preview', preview_key, \
+					lambda: self.render_preview(transform, rect, size[0], size[1]))
+			if self.preview is None:
+				return None
+			return self.photos.get(key, lambda: ImageTk.PhotoImage(self.view_preview(box, size)))
+
+	def view_preview(self, box, size):
+		preview = self.preview if self.preview.size == size else self.preview.resize(size)
+		return self.view_shown(box, size, preview)
+
+	def view_shown(self, box, size, shown):
+		# the visible part of the distorted image, or composed with that of the first image
+		if self.view_mode not in COMPARE_VIEWS:
+			return shown
+		with timing.stage('compare'):
+			return compare_views(self.pyramid1.crop_resized(box, size), shown, self.view_mode, self.alpha)
 
 	def draw_points(self):
-		for i, (_, p) in enumerate(self.point_pairs):
-			x1, y1 = self.to_canvas(p[0], p[1])
+		# only the points of which the circle is at least partly visible
+		x, y, w, h = self.visible_rect()
+		r = CIRC / self.scale
+		index = self.point_index()
+		indices = index.inside(x - r, y - r, x + w + r, y + h + r)
+		# as to_canvas
+		xs = np.round((index.points[indices, 0] - x) * self.scale).astype(int)
+		ys = np.round((index.points[indices, 1] - y) * self.scale).astype(int)
+		markers = []
+		for i, x1, y1 in zip(indices.tolist(), xs.tolist(), ys.tolist()):
 			color = DRAGGED_COLOR if self.mode == 'drag' and i == self.dragged_index \
 					else POINT_COLOR
-			self.canvas.create_oval(MARGIN+x1-CIRC, MARGIN+y1-CIRC, MARGIN+x1+CIRC, MARGIN+y1+CIRC, \
-				outline=color, width=2)
+			markers.append((x1, y1, color))
+		self.markers.show(markers)
 		if self.mode == 'drag':
 			(_, (px, py)) = self.point_pairs[self.dragged_index]
 			cx, cy = self.to_canvas(px, py)
 			arrow = tk.FIRST if self.view_mode == '1' else tk.LAST
 			self.canvas.create_line(self.x_canvas+MARGIN, self.y_canvas+MARGIN, 
-				cx+MARGIN, cy+MARGIN, fill=ARROW_COLOR, width=2, arrow=arrow)
+				cx+MARGIN, cy+MARGIN, fill=ARROW_COLOR, width=2, arrow=arrow, tags='arrow')
 
 	def motion_canvas(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		self.x_canvas = self.canvas.winfo_pointerx() - self.canvas.winfo_rootx() - MARGIN
 		self.y_canvas = self.canvas.winfo_pointery() - self.canvas.winfo_rooty() - MARGIN
@@ -297,7 +589,7 @@ class AlignImage(tk.Frame):
 			self.delayed_redraw()
 
 	def start_drag(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		self.drag_start = (self.x_canvas, self.y_canvas)
 		if self.view_mode in ['1','2']:
@@ -309,7 +601,7 @@ class AlignImage(tk.Frame):
 				self.show_drag()
 
 	def end_drag(self):
-		if self.image1 is None or self.drag_start is None:
+		if self.loader1 is None or self.drag_start is None:
 			return
 		x_from, y_from = self.drag_start
 		i, _ = self.nearest_point_index(x_from, y_from)
@@ -341,7 +633,7 @@ class AlignImage(tk.Frame):
 		self.normal_cursor()
 
 	def left(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		x, y = self.center
 		x -=  self.w_canvas / self.w_image1 / self.scale * ARROW_STEP
@@ -349,7 +641,7 @@ class AlignImage(tk.Frame):
 		self.adjust_pos()
 
 	def right(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		x, y = self.center
 		x +=  self.w_canvas / self.w_image1 / self.scale * ARROW_STEP
@@ -357,7 +649,7 @@ class AlignImage(tk.Frame):
 		self.adjust_pos()
 
 	def up(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		x, y = self.center
 		y -=  self.h_canvas / self.h_image1 / self.scale * ARROW_STEP
@@ -365,7 +657,7 @@ class AlignImage(tk.Frame):
 		self.adjust_pos()
 
 	def down(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		x, y = self.center
 		y +=  self.h_canvas / self.h_image1 / self.scale * ARROW_STEP
@@ -373,7 +665,7 @@ class AlignImage(tk.Frame):
 		self.adjust_pos()
 
 	def zoom_mouse(self, step):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		self.normal_cursor()
 		if self.x_canvas < 0 or self.y_canvas < 0 or \
@@ -389,13 +681,13 @@ class AlignImage(tk.Frame):
 		self.adjust_zoom()
 
 	def zoom(self, step):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		self.scale *= step
 		self.adjust_zoom()
 
 	def adjust_zoom(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		if self.scale * self.w_image1 < self.w_canvas and self.scale * self.h_image1 < self.h_canvas:
 			self.scale = min(self.w_canvas / self.w_image1, self.h_canvas / self.h_image1)
@@ -437,12 +729,7 @@ class AlignImage(tk.Frame):
 
 	def from_canvas2(self, px, py):
 		x, y = self.from_canvas1(self.x_canvas, self.y_canvas)
-		if self.poly_mode_var.get() == 'w':
-			pts_dst, pts_src, matches = split_point_pairs(self.point_pairs)
-			return unwarp_point(x, y, pts_dst, pts_src, matches)
-		else:
-			triangle_pairs = point_pairs_to_triangle_pairs(self.point_pairs)
-			return undistort_point(x, y, triangle_pairs)
+		return self.compiled_transform().undistort_point(x, y)
 
 	def key(self, event):
 		if event.char == ' ':
@@ -469,9 +756,13 @@ class AlignImage(tk.Frame):
 			self.add_auto()
 		elif event.char == 'f':
 			self.add_auto_four()
+		elif event.char == '[':
+			self.change_alpha(-ALPHA_STEP)
+		elif event.char == ']':
+			self.change_alpha(ALPHA_STEP)
 
 	def register_point(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		x, y = self.from_canvas1(self.x_canvas, self.y_canvas)
 		p = self.from_canvas2(self.x_canvas, self.y_canvas)
@@ -480,7 +771,7 @@ class AlignImage(tk.Frame):
 			self.set_distorted()
 
 	def unregister_point(self, event):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		i, d = self.nearest_point_index(self.x_canvas, self.y_canvas)
 		if i >= 0:
@@ -489,22 +780,17 @@ class AlignImage(tk.Frame):
 			self.set_distorted()
 
 	def delete_points(self):
-		if self.image1 is None:
+		if self.loader1 is None:
 			return
 		self.point_pairs = []
 		self.normalize_point_pairs()
 		self.set_distorted()
 
 	def nearest_point_index(self, x_canvas, y_canvas):
-		best_i = -1
-		best_d = math.inf
-		for i, (_, (px, py)) in enumerate(self.point_pairs):
-			cx, cy = self.to_canvas(px, py)
-			d = math.dist((cx, cy), (x_canvas, y_canvas))
-			if d < best_d:
-				best_d = d
-				best_i = i
-		return best_i, best_d
+		# the distance is in pixels of the canvas
+		x, y, _, _ = self.visible_rect()
+		i, d = self.point_index().nearest(x + x_canvas / self.scale, y + y_canvas / self.scale)
+		return i, d * self.scale
 
 	def show_wait(self):
 		self.winfo_toplevel().config(cursor='watch')
@@ -532,30 +818,54 @@ class AlignImageStandalone(AlignImage):
 		self.point_file = point_file
 
 	def save(self):
-		self.distorted.save(self.image_file)
+		save_image(self.exact_distorted(), self.image_file)
 		write_point_pairs(self.point_pairs, self.point_file)
 
 if __name__ == '__main__':
 	point_file_in = None
 	point_file_out = 'pointpairs.csv'
 	image_file = 'distorted.png'
+	multiscale = False
+	features = 'sift'
+	bruteforce = False
+	grid_size = GRID_SIZE
 	try:
-		opts, vals = getopt(sys.argv[1:], 'p:d:', ['points=', 'distorted='])
+		opts, vals = getopt(sys.argv[1:], 'p:d:mf:bg:t:', \
+			['points=', 'distorted=', 'multiscale', 'features=', 'bruteforce', 'grid=', 'timing='])
 	except GetoptError as err:
 		print(err)
 		sys.exit(1)
 	if len(vals) != 2:
 		print('Required are two arguments (images)')
 		sys.exit(1)
-	image1 = Image.open(vals[0])
-	image2 = Image.open(vals[1])
 	for opt, val in opts:
 		if opt in ('-p', '--points'):
 			point_file_in = val
 		elif opt in ('-d', '--distorted'):
 			image_file = val
+		elif opt in ('-m', '--multiscale'):
+			multiscale = True
+		elif opt in ('-f', '--features'):
+			features = val
+			if features not in DETECTORS:
+				print('Features must be one of: ' + ', '.join(DETECTORS))
+				sys.exit(1)
+		elif opt in ('-b', '--bruteforce'):
+			bruteforce = True
+		elif opt in ('-g', '--grid'):
+			grid_size = int(val)
+		elif opt in ('-t', '--timing'):
+			timing.enable(val)
+	start_time = time.perf_counter()
+	image1 = ImageLoader(vals[0])
+	image2 = ImageLoader(vals[1])
 	point_pairs = read_point_pairs(point_file_in) if point_file_in is not None else []
 	root = tk.Tk()
 	app = AlignImageStandalone(root)
+	app.multiscale = multiscale
+	app.features_var.set(features)
+	app.bruteforce = bruteforce
+	app.grid_size = grid_size
+	app.start_time = start_time
 	app.set_images(image1, image2, point_pairs, image_file, point_file_out)
 	app.mainloop()
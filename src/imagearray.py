@@ -0,0 +1,195 @@
+import math
+import numpy as np
+import cv2
+from PIL import Image
+
+# images are NumPy arrays of shape (h, w) or (h, w, channels), in the format in which they were
+# read; images of other modes than these are converted to RGB when loaded
+IMAGE_MODES = ['L', 'LA', 'RGB', 'RGBA', 'I;16', 'F']
+# cv2.remap and cv2.cvtColor take at most four channels
+MAX_CV_CHANNELS = 4
+# array types, as type and number of channels, that PIL saves, those it saves only as TIFF, and
+# those that cv2 saves as PNG; other types are saved as TIFF through tifffile, or as .npy
+PIL_SAVE_TYPES = [(np.uint8, 1), (np.uint8, 2), (np.uint8, 3), (np.uint8, 4), (np.uint16, 1)]
+PIL_TIFF_TYPES = [(np.int32, 1), (np.float32, 1)]
+CV_PNG_TYPES = [(np.uint16, 3), (np.uint16, 4)]
+# images are first shown reduced by a power of two to at most this many pixels
+REDUCED_PIXELS = 4000000
+
+def as_array(image):
+	if isinstance(image, np.ndarray):
+		return image
+	if image.mode not in IMAGE_MODES:
+		image = image.convert('RGB')
+	return np.asarray(image)
+
+def load_image(path):
+	if path.lower().endswith('.npy'):
+		return np.load(path, mmap_mode='r')
+	return as_array(Image.open(path))
+
+def file_image_size(path):
+	# without decoding the pixels
+	if path.lower().endswith('.npy'):
+		shape = np.load(path, mmap_mode='r').shape
+		return shape[1], shape[0]
+	with Image.open(path) as image:
+		return image.size
+
+def reduction_factor(size, max_pixels=REDUCED_PIXELS):
+	w, h = size
+	factor = 1
+	while w * h > max_pixels * factor * factor:
+		factor *= 2
+	return factor
+
+def fit_image(image, size):
+	# to the exact size of reduce_image, from a reduced level of the file of about that size
+	if image_size(image) == size:
+		return image
+	return cv2.resize(np.ascontiguousarray(image), size, interpolation=cv2.INTER_AREA)
+
+def select_level(image, factor):
+	# for decoding at a reduced resolution, where the format has it
+	w, h = image.size
+	w_reduced, h_reduced = math.ceil(w / factor), math.ceil(h / factor)
+	if image.format == 'JPEG':
+		# scaled decoding of JPEG, by at most 8
+		image.draft(image.mode, (w_reduced, h_reduced))
+	elif image.format == 'JPEG2000':
+		image.reduce = int(math.log2(factor))
+	elif image.format == 'TIFF' and getattr(image, 'n_frames', 1) > 1:
+		# the smallest page of the same proportions that is at least as large
+		best = None
+		for i in range(image.n_frames):
+			image.seek(i)
+			w_page, h_page = image.size
+			if w_page >= w_reduced and h_page >= h_reduced and abs(w_page * h - h_page * w) <= max(w, h) and \
+					(best is None or w_page < best[1]):
+				best = (i, w_page)
+		image.seek(best[0])
+
+def load_reduced(path, factor):
+	# the image reduced by a power of two factor, and the full image if that had to be decoded
+	if factor == 1:
+		image = load_image(path)
+		return image, image
+	size = tuple(math.ceil(n / factor) for n in file_image_size(path))
+	if path.lower().endswith('.npy'):
+		# subsampled, reading only part of the file
+		source = np.load(path, mmap_mode='r')
+		return fit_image(np.ascontiguousarray(source[::factor, ::factor]), size), None
+	image = Image.open(path)
+	w = image.size[0]
+	try:
+		select_level(image, factor)
+		reduced = as_array(image)
+	except (OSError, ValueError):
+		# no reduced level that can be decoded
+		reduced = as_array(Image.open(path))
+	obtained = max(1, 2 ** math.floor(math.log2(w / image_size(reduced)[0])))
+	if obtained == 1:
+		return fit_image(reduce_image(reduced, factor), size), reduced
+	return fit_image(reduce_image(reduced, factor // obtained) if factor > obtained else reduced, size), None
+
+def is_tiff(path):
+	return path.lower().endswith('.tif') or path.lower().endswith('.tiff')
+
+def save_tiff(image, path):
+	# any type and number of channels, which requires tifffile
+	import tifffile
+	photometric = 'rgb' if channels(image) in (3, 4) else 'minisblack'
+	tifffile.imwrite(path, image, photometric=photometric, \
+		planarconfig='contig' if image.ndim == 3 else None)
+
+def save_image(image, path):
+	image_type = (image.dtype.type, channels(image))
+	if path.lower().endswith('.npy'):
+		np.save(path, image)
+	elif image_type in PIL_SAVE_TYPES or is_tiff(path) and image_type in PIL_TIFF_TYPES:
+		Image.fromarray(image).save(path)
+	elif is_tiff(path):
+		save_tiff(image, path)
+	elif image_type in CV_PNG_TYPES and path.lower().endswith('.png'):
+		if image.ndim == 3:
+			image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR if image.shape[2] == 3 else cv2.COLOR_RGBA2BGRA)
+		cv2.imwrite(path, image)
+	else:
+		raise ValueError('Images of type %s with %d channels can only be saved as .npy or .tif: %s' % \
+			(image.dtype, channels(image), path))
+
+def image_size(image):
+	if isinstance(image, np.ndarray):
+		return image.shape[1], image.shape[0]
+	return image.size
+
+def channels(image):
+	return image.shape[2] if image.ndim == 3 else 1
+
+def white_value(dtype):
+	if np.issubdtype(dtype, np.integer):
+		return np.iinfo(dtype).max
+	return 1.0
+
+def to_uint8(image):
+	if image.dtype == np.uint8:
+		return image
+	if image.dtype == np.uint16:
+		return (image >> 8).astype(np.uint8)
+	if np.issubdtype(image.dtype, np.integer):
+		return np.clip(image, 0, 255).astype(np.uint8)
+	return (np.clip(image, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+def gray_image(image):
+	# 8 bits, as taken by feature detectors
+	image = to_uint8(np.asarray(image))
+	if image.ndim == 2:
+		return image
+	if image.shape[2] < 3:
+		return np.ascontiguousarray(image[:, :, 0])
+	return cv2.cvtColor(np.ascontiguousarray(image[:, :, :3]), cv2.COLOR_RGB2GRAY)
+
+def display_image(image):
+	# 8-bit RGB, from the first three channels or from the first channel if fewer
+	image = to_uint8(image)
+	if image.ndim == 2:
+		return Image.fromarray(image).convert('RGB')
+	if image.shape[2] < 3:
+		return Image.fromarray(np.ascontiguousarray(image[:, :, 0])).convert('RGB')
+	return Image.fromarray(np.ascontiguousarray(image[:, :, :3]))
+
+def reduce_image(image, factor):
+	# box averages of factor x factor pixels, as Image.reduce, with the last row and column
+	# of boxes padded by repetition
+	h, w = image.shape[:2]
+	w_reduced = math.ceil(w / factor)
+	h_reduced = math.ceil(h / factor)
+	padded = cv2.copyMakeBorder(np.ascontiguousarray(image), 0, h_reduced * factor - h, \
+		0, w_reduced * factor - w, cv2.BORDER_REPLICATE)
+	return cv2.resize(padded, (w_reduced, h_reduced), interpolation=cv2.INTER_AREA)
+
+def crop_image(image, box):
+	# as Image.crop, black outside the image
+	x0, y0, x1, y1 = box
+	h, w = image.shape[:2]
+	if x0 >= 0 and y0 >= 0 and x1 <= w and y1 <= h:
+		return image[y0:y1, x0:x1]
+	cropped = np.zeros((y1-y0, x1-x0) + image.shape[2:], dtype=image.dtype)
+	xa, ya, xb, yb = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+	if xa < xb and ya < yb:
+		cropped[ya-y0:yb-y0, xa-x0:xb-x0] = image[ya:yb, xa:xb]
+	return cropped
+
+def remap_channels(source, map1, map2, interpolation, border_value=0):
+	# cv2.remap in groups of at most four channels
+	if channels(source) <= MAX_CV_CHANNELS:
+		return cv2.remap(np.ascontiguousarray(source), map1, map2, interpolation, \
+			borderMode=cv2.BORDER_CONSTANT, borderValue=(border_value,) * MAX_CV_CHANNELS)
+	h, w = map1.shape[:2]
+	target = np.empty((h, w, source.shape[2]), dtype=source.dtype)
+	for c in range(0, source.shape[2], MAX_CV_CHANNELS):
+		group = np.ascontiguousarray(source[:, :, c:c+MAX_CV_CHANNELS])
+		remapped = cv2.remap(group, map1, map2, interpolation, \
+			borderMode=cv2.BORDER_CONSTANT, borderValue=(border_value,) * MAX_CV_CHANNELS)
+		target[:, :, c:c+MAX_CV_CHANNELS] = remapped.reshape((h, w, -1))
+	return target
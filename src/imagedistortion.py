@@ -4,10 +4,26 @@ import sys
 import os
 import csv
 import math
+import functools
 import numpy as np
+from getopt import getopt, GetoptError
 from PIL import Image, ImageDraw
 
-from bilinear import BilinearMap
+from bilinear import BilinearMap, BilinearBuffers, bilinear_table, map_bilinear_table
+from imagearray import as_array, image_size, white_value, reduce_image, remap_channels
+from timing import timing, timed
+
+WARP_TOLERANCE = 0.25
+WARP_MAX_STEP = 64
+# below this step, checking the lattice would sample a large part of the grid
+WARP_MIN_STEP = 8
+GRID_CACHE_SIZE = 8
+# larger grids, such as those of whole images, are built for each call, so that at most
+# GRID_CACHE_SIZE grids of 8 bytes per pixel are kept
+GRID_CACHE_PIXELS = 1 << 21
+# fixed-point maps hold coordinates as 16-bit integers
+FIXED_POINT_MAPS = True
+FIXED_POINT_LIMIT = 32000
 
 def equal_edge(e1, e2):
 	return e1[0] == e2[0] and e1[1] == e2[1] or e1[0] == e2[1] and e1[1] == e2[0]
@@ -29,14 +45,6 @@ def longest_edge(t):
 	edges = [(p1, p2), (p2, p3), (p3, p1)]
 	return min(edges, key=lambda e: distance.euclidean(e[0], e[1]))
 
-def edge_triangle_index(edge, triangles):
-	points = set(edge)
-	for i, t in enumerate(triangles):
-		points2 = set(t)
-		if points.issubset(points2):
-			return i
-	return -1
-
 def merge_triangle_pairs(edge, triangle_pair1, triangle_pair2):
 	points1 = []
 	points2 = []
@@ -64,7 +72,7 @@ def merge_triangle_pairs(edge, triangle_pair1, triangle_pair2):
 			points1.append(p)
 			points2.append(triangle_pair1[1][i])
 			break
-	return (points1, points2)
+	return (tuple(points1), tuple(points2))
 
 def triangle_area(t):
 	# Heron's formula
@@ -121,19 +129,6 @@ def quads_to_transform(t1, t2):
 	outputs = np.float32(t2)
 	return cv2.getPerspectiveTransform(inputs, outputs)
 
-def quad_distort(source, transform, w, h):
-	source_cv = cv2.cvtColor(np.array(source), cv2.COLOR_RGB2BGR)
-	target_cv = cv2.warpPerspective(source_cv, transform, (w, h))
-	return Image.fromarray(cv2.cvtColor(target_cv, cv2.COLOR_BGR2RGB))
-
-def bilinear_distort(source, transform, w, h):
-	source_cv = cv2.cvtColor(np.array(source), cv2.COLOR_RGB2BGR)
-	grid = get_grid(w, h)
-	grid_warped = transform.map_grid_fast(grid)
-	target_cv = cv2.remap(source_cv, grid_warped[:, :, 0], grid_warped[:, :, 1], cv2.INTER_CUBIC)
-	target = Image.fromarray(cv2.cvtColor(target_cv, cv2.COLOR_BGR2RGB))
-	return target
-
 def in_triangle(x, y, t):
 	((x1,y1), (x2,y2), (x3,y3)) = t
 	v1 = (x - x2) * (y1 - y2) - (x1 - x2) * (y - y2)
@@ -155,20 +150,26 @@ def in_triangle(x, y, t):
 		return (v1 * v2 > 0) and (v2 * v3 > 0)
 
 def do_delaunay(source_points):
+	# the triangles, and per triangle the neighbouring triangle opposite each vertex, or -1
+	delaunay = Delaunay(source_points)
 	triangles = []
-	for indices in Delaunay(source_points).simplices:
+	for indices in delaunay.simplices:
 		p1 = source_points[indices[0]]
 		p2 = source_points[indices[1]]
 		p3 = source_points[indices[2]]
 		triangles.append((p1, p2, p3))
-	return triangles
+	return triangles, delaunay.neighbors
 
-def point_pairs_to_triangle_pairs(point_pairs):
+@timed('delaunay')
+def triangulate(point_pairs):
 	source_points = [(x1, y1) for ((x1, y1), _) in point_pairs]
 	source_to_target = {p1: p2 for (p1, p2) in point_pairs}
-	triangles = do_delaunay(source_points)
+	triangles, neighbors = do_delaunay(source_points)
 	return [((p1, p2, p3), (source_to_target[p1], source_to_target[p2], source_to_target[p3])) \
-		for (p1, p2, p3) in triangles]
+		for (p1, p2, p3) in triangles], neighbors
+
+def point_pairs_to_triangle_pairs(point_pairs):
+	return triangulate(point_pairs)[0]
 
 def split_point_pairs(point_pairs):
 	source_points = [[x, y] for ((x, y), _) in point_pairs]
@@ -193,16 +194,44 @@ def polygon_mask(t, w, h):
 	draw.polygon(list(t), fill=255, outline=None)
 	return mask
 
-def merge_triangles(triangle_pairs):
+def triangle_neighbors(triangles):
+	# as Delaunay.neighbors, from an index of the triangles by edge
+	edge_triangles = {}
+	for i, t in enumerate(triangles):
+		for k in range(3):
+			edge = frozenset((t[(k+1) % 3], t[(k+2) % 3]))
+			edge_triangles.setdefault(edge, []).append(i)
+	neighbors = []
+	for i, t in enumerate(triangles):
+		row = []
+		for k in range(3):
+			others = [j for j in edge_triangles[frozenset((t[(k+1) % 3], t[(k+2) % 3]))] if j != i]
+			row.append(others[0] if others else -1)
+		neighbors.append(row)
+	return neighbors
+
+@timed('merge_triangles')
+def merge_triangles(triangle_pairs, neighbors=None):
+	# triangles are taken from the end of the list, and merged with the neighbour across their
+	# most diagonal edge if that has not been taken yet; neighbors is as Delaunay.neighbors
+	# for the triangles, and is otherwise determined from the shared edges
+	if neighbors is None:
+		neighbors = triangle_neighbors([t1 for (t1, _) in triangle_pairs])
+	taken = [False] * len(triangle_pairs)
 	pairs = []
-	while len(triangle_pairs) > 0:
-		triangle_pair = triangle_pairs.pop()
+	for i in range(len(triangle_pairs) - 1, -1, -1):
+		if taken[i]:
+			continue
+		taken[i] = True
+		triangle_pair = triangle_pairs[i]
 		edge = most_diagonal_edge(triangle_pair[0])
-		i = edge_triangle_index(edge, [t1 for (t1, t2) in triangle_pairs])
-		if i < 0:
+		k = next(k for k in range(3) if triangle_pair[0][k] not in edge)
+		j = neighbors[i][k]
+		if j < 0 or taken[j]:
 			pairs.append(triangle_pair)
 		else:
-			triangle_pair2 = triangle_pairs.pop(i)
+			taken[j] = True
+			triangle_pair2 = triangle_pairs[j]
 			merged_quad_pair = merge_triangle_pairs(edge, triangle_pair, triangle_pair2)
 			if quad_convex(merged_quad_pair[0]) and quad_convex(merged_quad_pair[1]):
 				pairs.append(merged_quad_pair)
@@ -211,31 +240,172 @@ def merge_triangles(triangle_pairs):
 				pairs.append(triangle_pair2)
 	return pairs
 
-def distort_image(source, pairs, w, h, bilinear):
-	target = Image.new(mode='RGB', size=(w,h), color='black')
-	for (t1, t2) in pairs:
-		t1_norm, x1, y1, w1, h1 = normalize_polygon(t1)
-		t2_norm, x2, y2, w2, h2 = normalize_polygon(t2)
-		w3 = max(w1, w2)
-		h3 = max(h1, h2)
-		if len(t1_norm) == 3:
-			af = triangles_to_affine(t2_norm, t1_norm)
-			sub_source = source.crop((x1, y1, x1+w3, y1+h3))
-			sub_target = sub_source.transform(sub_source.size, Image.AFFINE, af, resample=Image.BICUBIC)
-			mask_target = polygon_mask(t2_norm, w3, h3)
-			target.paste(sub_target, (x2, y2), mask_target)
-		elif len(t1_norm) == 4:
-			sub_source = source.crop((x1, y1, x1+w3, y1+h3))
-			if bilinear:
-				transform = BilinearMap(t2_norm, t1_norm)
-				sub_target = bilinear_distort(sub_source, transform, w3, h3)
+def polygon_bounds(t, x, y, w, h):
+	xs = [p[0] for p in t]
+	ys = [p[1] for p in t]
+	x_min = max(math.floor(min(xs)) - x, 0)
+	y_min = max(math.floor(min(ys)) - y, 0)
+	x_max = min(math.ceil(max(xs)) - x + 1, w)
+	y_max = min(math.ceil(max(ys)) - y + 1, h)
+	return x_min, y_min, x_max, y_max
+
+@timed('labels')
+def polygon_labels(pairs, x, y, w, h):
+	labels = np.zeros((h, w), dtype=np.int32)
+	for i, (_, t2) in enumerate(pairs):
+		x_min, y_min, x_max, y_max = polygon_bounds(t2, x, y, w, h)
+		if x_min >= x_max or y_min >= y_max:
+			continue
+		# rasterization is not exactly invariant to moving in x, so the polygon keeps its own
+		# x origin; moving whole rows is exact, so only the rows of the rect are drawn
+		x2 = math.floor(min([p[0] for p in t2]))
+		t2_norm = moved_polygon(t2, -x2, -(y+y_min))
+		mask = np.array(polygon_mask(t2_norm, x_max+x-x2, y_max-y_min))
+		mask = mask[:, x_min+x-x2:] > 0
+		labels[y_min:y_max, x_min:x_max][mask] = i+1
+	return labels
+
+def triangle_source_coords(t1, t2, xs, ys):
+	t1_norm, x1, y1, _, _ = normalize_polygon(t1)
+	t2_norm, x2, y2, _, _ = normalize_polygon(t2)
+	af = triangles_to_affine(t2_norm, t1_norm)
+	# same pixel-centre convention as Image.transform
+	xs_src, ys_src = apply_affine(xs - x2 + 0.5, ys - y2 + 0.5, af)
+	return xs_src - 0.5 + x1, ys_src - 0.5 + y1
+
+def quad_source_coords(t1, t2, xs, ys):
+	t1_norm, x1, y1, _, _ = normalize_polygon(t1)
+	t2_norm, x2, y2, _, _ = normalize_polygon(t2)
+	_, inv = cv2.invert(quads_to_transform(t1_norm, t2_norm))
+	xs = xs - x2
+	ys = ys - y2
+	ws = inv[2][0] * xs + inv[2][1] * ys + inv[2][2]
+	xs_src = (inv[0][0] * xs + inv[0][1] * ys + inv[0][2]) / ws
+	ys_src = (inv[1][0] * xs + inv[1][1] * ys + inv[1][2]) / ws
+	return xs_src + x1, ys_src + y1
+
+def bilinear_fill(t1, t2, mask, x, y, map_x, map_y, buffers):
+	# only the pixels of the mask are evaluated, without temporaries the size of the bounding box
+	t1_norm, x1, y1, _, _ = normalize_polygon(t1)
+	t2_norm, x2, y2, _, _ = normalize_polygon(t2)
+	rows, cols = np.nonzero(mask)
+	xs, ys, xs_src, ys_src = buffers.points(len(rows))
+	np.add(cols, x - x2, out=xs, casting='unsafe')
+	np.add(rows, y - y2, out=ys, casting='unsafe')
+	BilinearMap(t2_norm, t1_norm).map_points(xs, ys, xs_src, ys_src, buffers)
+	map_x[mask] = np.add(xs_src, x1, out=xs_src)
+	map_y[mask] = np.add(ys_src, y1, out=ys_src)
+
+@timed('source_maps')
+def polygon_source_maps(pairs, labels, x, y, bilinear):
+	h, w = labels.shape
+	map_x = np.full((h, w), -1, dtype=np.float32)
+	map_y = np.full((h, w), -1, dtype=np.float32)
+	buffers = BilinearBuffers()
+	for i, (t1, t2) in enumerate(pairs):
+		x_min, y_min, x_max, y_max = polygon_bounds(t2, x, y, w, h)
+		if x_min >= x_max or y_min >= y_max:
+			continue
+		mask = labels[y_min:y_max, x_min:x_max] == i+1
+		if not mask.any():
+			continue
+		with timing.stage('polygon', index=i, vertices=len(t1)):
+			if len(t1) == 4 and bilinear:
+				bilinear_fill(t1, t2, mask, x_min + x, y_min + y, \
+					map_x[y_min:y_max, x_min:x_max], map_y[y_min:y_max, x_min:x_max], buffers)
+				continue
+			xs, ys = np.meshgrid(np.arange(x_min + x, x_max + x, dtype=np.float64), \
+					np.arange(y_min + y, y_max + y, dtype=np.float64))
+			if len(t1) == 3:
+				xs_src, ys_src = triangle_source_coords(t1, t2, xs, ys)
 			else:
-				transform = quads_to_transform(t1_norm, t2_norm)
-				sub_target = quad_distort(sub_source, transform, w3, h3)
-			mask_target = polygon_mask(t2_norm, w3, h3)
-			target.paste(sub_target, (x2, y2), mask_target)
+				xs_src, ys_src = quad_source_coords(t1, t2, xs, ys)
+			map_x[y_min:y_max, x_min:x_max][mask] = xs_src[mask]
+			map_y[y_min:y_max, x_min:x_max][mask] = ys_src[mask]
+	return map_x, map_y
+
+@timed('compact_maps')
+def compact_maps(map1, map2, source_size):
+	# cv2.remap quantizes coordinates to 1/32 pixel itself, so the result is the same, from 6 instead
+	# of 8 bytes per pixel; coordinates saturate at the 16-bit range, which for a source well within
+	# that range still lie outside it
+	w, h = source_size
+	if max(w, h) >= FIXED_POINT_LIMIT:
+		return map1, map2
+	return cv2.convertMaps(map1, map2, cv2.CV_16SC2)
+
+def linear_labels(pairs, labels, bilinear):
+	# quadrilaterals in perspective are interpolated linearly, as cv2.warpPerspective did for
+	# them, and all other polygons cubically
+	if bilinear:
+		return None
+	quads = np.array([False] + [len(t1) == 4 for (t1, _) in pairs])
+	return quads[labels] if quads.any() else None
+
+def remap_linear(source, map_x, map_y, linear, target):
+	# within the bounding box of the linearly interpolated pixels
+	rows = np.flatnonzero(linear.any(axis=1))
+	cols = np.flatnonzero(linear.any(axis=0))
+	if len(rows) == 0:
+		return
+	window = np.s_[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+	remapped = remap_channels(source, np.ascontiguousarray(map_x[window]), \
+		np.ascontiguousarray(map_y[window]), cv2.INTER_LINEAR)
+	target[window][linear[window]] = remapped[linear[window]]
+
+@timed('remap')
+def remap_image(source, map_x, map_y, labels, linear=None):
+	target = remap_channels(source, map_x, map_y, cv2.INTER_CUBIC)
+	if linear is not None:
+		remap_linear(source, map_x, map_y, linear, target)
+	target[labels == 0] = 0
 	return target
 
+def distort_rect(source, pairs, x, y, w, h, bilinear, fixed_point=FIXED_POINT_MAPS):
+	labels = polygon_labels(pairs, x, y, w, h)
+	map_x, map_y = polygon_source_maps(pairs, labels, x, y, bilinear)
+	if fixed_point:
+		map_x, map_y = compact_maps(map_x, map_y, image_size(source))
+	return remap_image(source, map_x, map_y, labels, linear_labels(pairs, labels, bilinear))
+
+def distort_image(source, pairs, w, h, bilinear, fixed_point=FIXED_POINT_MAPS):
+	return distort_rect(as_array(source), pairs, 0, 0, w, h, bilinear, fixed_point)
+
+def dirty_rect(pairs, w, h):
+	bounds = [polygon_bounds(t2, 0, 0, w, h) for (_, t2) in pairs]
+	x_min = min([b[0] for b in bounds], default=w)
+	y_min = min([b[1] for b in bounds], default=h)
+	x_max = max([b[2] for b in bounds], default=0)
+	y_max = max([b[3] for b in bounds], default=0)
+	if x_min >= x_max or y_min >= y_max:
+		return None
+	return x_min, y_min, x_max-x_min, y_max-y_min
+
+class IncrementalDistortion:
+	def __init__(self, source, w, h):
+		self.source = as_array(source)
+		self.w = w
+		self.h = h
+		self.pairs = []
+		self.bilinear = None
+		self.target = None
+
+	def distort(self, pairs, bilinear):
+		# the pairs are in the fixed order of CompiledTransform, so that pixels on shared edges
+		# keep their polygon between edits
+		if self.target is None or bilinear != self.bilinear:
+			self.target = distort_rect(self.source, pairs, 0, 0, self.w, self.h, bilinear)
+		else:
+			changed = set(self.pairs).symmetric_difference(pairs)
+			rect = dirty_rect(changed, self.w, self.h)
+			if rect is not None:
+				x, y, w, h = rect
+				self.target[y:y+h, x:x+w] = distort_rect(self.source, pairs, x, y, w, h, bilinear)
+		self.pairs = pairs
+		self.bilinear = bilinear
+		# a copy, as the target is updated in place by the next edit
+		return self.target.copy()
+
 def distort_point(x, y, triangle_pairs):
 	for (t1, t2) in triangle_pairs:
 		if in_triangle(x, y, t1):
@@ -256,46 +426,438 @@ def undistort_point(x, y, triangle_pairs):
 			return (int(x3 + x1), int(y3 + y1))
 	return None
 
-def distort_points(in_points, triangle_pairs):
+def view_polygon(t, view):
+	# pixel centres of the view fall on those of the image, as with Image.resize
+	(x, y, scale_x, scale_y) = view
+	return tuple([((px - x + 0.5) * scale_x - 0.5, (py - y + 0.5) * scale_y - 0.5) for (px, py) in t])
+
+def view_polygon_pairs(pairs, view, source_scale):
+	source_view = (0, 0, source_scale, source_scale)
+	return [(view_polygon(t1, source_view), view_polygon(t2, view)) for (t1, t2) in pairs]
+
+def view_warp(source, source_scale, tps, view, w, h, image_size, padded_size):
+	grid_warped, _ = approximate_warp_grid(tps, w, h, WARP_TOLERANCE / source_scale, view)
+	map_x = (grid_warped[:, :, 0] + 0.5) * source_scale - 0.5
+	map_y = (grid_warped[:, :, 1] + 0.5) * source_scale - 0.5
+	# as warp_image_grid, white up to the padded size and black beyond
+	target = remap_channels(source, map_x, map_y, cv2.INTER_LINEAR, white_value(source.dtype))
+	outside = outside_rect(grid_warped, padded_size) | \
+		outside_rect(view_to_image(get_grid(w, h), view), image_size)
+	target[outside] = 0
+	return target
+
+def outside_rect(grid, size):
+	(w, h) = size
+	return (grid[:, :, 0] < -0.5) | (grid[:, :, 0] > w - 0.5) | \
+		(grid[:, :, 1] < -0.5) | (grid[:, :, 1] > h - 0.5)
+
+class ViewDistortion:
+	def __init__(self, source, factor=1, size=None):
+		# the source may already be reduced by a power of two factor, from an image of the given size
+		self.source = as_array(source)
+		self.factor = factor
+		self.size = image_size(self.source) if size is None else size
+		self.reduced = {factor: self.source}
+
+	def reduced_source(self, scale):
+		factor = self.factor
+		while factor * 2 <= 1 / scale:
+			factor *= 2
+		if factor not in self.reduced:
+			self.reduced[factor] = reduce_image(self.source, factor // self.factor)
+		return self.reduced[factor], 1 / factor
+
+	def distort(self, transform, rect, w, h, w_image, h_image):
+		x, y, w_rect, h_rect = rect
+		view = (x, y, w / w_rect, h / h_rect)
+		source, source_scale = self.reduced_source(min(view[2], view[3]))
+		if transform.poly_mode == 'w':
+			w_source, h_source = self.size
+			target = view_warp(source, source_scale, transform.tps, view, w, h, (w_image, h_image), \
+				(max(w_image, w_source), max(h_image, h_source)))
+		else:
+			pairs = view_polygon_pairs(transform.pairs, view, source_scale)
+			target = distort_rect(source, pairs, 0, 0, w, h, transform.poly_mode == 'b')
+		return target
+
+def polygon_affines(polygon_pairs):
+	affines = np.empty((len(polygon_pairs), 10))
+	for i, (t1, t2) in enumerate(polygon_pairs):
+		t1_norm, x1, y1, _, _ = normalize_polygon(t1)
+		t2_norm, x2, y2, _, _ = normalize_polygon(t2)
+		affines[i, :6] = triangles_to_affine(t1_norm, t2_norm)
+		affines[i, 6:] = (x1, y1, x2, y2)
+	return affines
+
+def apply_affines(points, indices, affines):
+	mapped = np.full(points.shape, np.nan)
+	inside = indices >= 0
+	af = affines[indices[inside]]
+	xs = points[inside, 0] - af[:, 6]
+	ys = points[inside, 1] - af[:, 7]
+	mapped[inside, 0] = af[:, 0] * xs + af[:, 1] * ys + af[:, 2] + af[:, 8]
+	mapped[inside, 1] = af[:, 3] * xs + af[:, 4] * ys + af[:, 5] + af[:, 9]
+	return mapped, ~inside
+
+def polygon_grid(polygons, cell):
+	x_min = polygons[:, :, 0].min()
+	y_min = polygons[:, :, 1].min()
+	cells_x = polygons[:, :, 0] - x_min
+	cells_y = polygons[:, :, 1] - y_min
+	n_cols = int(cells_x.max() // cell) + 1
+	n_rows = int(cells_y.max() // cell) + 1
+	polygon_cells = []
+	for i in range(len(polygons)):
+		cols = np.arange(int(cells_x[i].min() // cell), int(cells_x[i].max() // cell) + 1)
+		rows = np.arange(int(cells_y[i].min() // cell), int(cells_y[i].max() // cell) + 1)
+		polygon_cells.append((rows[:, np.newaxis] * n_cols + cols).ravel())
+	counts = [len(c) for c in polygon_cells]
+	cells = np.concatenate(polygon_cells)
+	indices = np.repeat(np.arange(len(polygons)), counts)
+	order = np.lexsort((indices, cells))
+	cells = cells[order]
+	indices = indices[order]
+	starts = np.searchsorted(cells, np.arange(n_rows * n_cols + 1))
+	return (x_min, y_min, cell, n_cols, n_rows), starts, indices
+
+def in_polygons(points, polygons):
+	# convex polygons, boundary included
+	n = polygons.shape[1]
+	crosses = []
+	for i in range(n):
+		p = polygons[:, i]
+		q = polygons[:, (i+1) % n]
+		crosses.append((q[:, 0] - p[:, 0]) * (points[:, 1] - p[:, 1]) - \
+			(q[:, 1] - p[:, 1]) * (points[:, 0] - p[:, 0]))
+	crosses = np.stack(crosses)
+	eps = 1e-9 * (np.abs(crosses).max(axis=0) + 1)
+	return (crosses >= -eps).all(axis=0) | (crosses <= eps).all(axis=0)
+
+def locate_polygons(points, polygons):
+	# first polygon in list order that contains each point, or -1
+	polygons = np.float64(polygons)
+	sizes = polygons.max(axis=1) - polygons.min(axis=1)
+	cell = max(np.sqrt((sizes[:, 0] * sizes[:, 1]).mean()), 1)
+	(x_min, y_min, cell, n_cols, n_rows), starts, indices = polygon_grid(polygons, cell)
+	cols = np.floor((points[:, 0] - x_min) / cell).astype(np.int64)
+	rows = np.floor((points[:, 1] - y_min) / cell).astype(np.int64)
+	in_grid = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+	cells = np.where(in_grid, rows * n_cols + cols, 0)
+	begins = np.where(in_grid, starts[cells], 0)
+	counts = np.where(in_grid, starts[cells+1] - begins, 0)
+	found = np.full(len(points), -1, dtype=np.int64)
+	for j in range(counts.max(initial=0)):
+		todo = np.nonzero((found < 0) & (counts > j))[0]
+		candidates = indices[begins[todo] + j]
+		hit = in_polygons(points[todo], polygons[candidates])
+		found[todo[hit]] = candidates[hit]
+	return found
+
+class PointMapping:
+	def __init__(self, point_pairs):
+		source_points = [(x1, y1) for ((x1, y1), _) in point_pairs]
+		source_to_target = {p1: p2 for (p1, p2) in point_pairs}
+		with timing.stage('delaunay'):
+			self.delaunay = Delaunay(source_points)
+		self.triangle_pairs = []
+		for indices in self.delaunay.simplices:
+			t1 = tuple([source_points[i] for i in indices])
+			t2 = tuple([source_to_target[p] for p in t1])
+			self.triangle_pairs.append((t1, t2))
+		self.forward = polygon_affines(self.triangle_pairs)
+		self.inverse = polygon_affines([(t2, t1) for (t1, t2) in self.triangle_pairs])
+
+	def distort_points(self, points):
+		# the first triangle that contains a point, as on shared edges and vertices find_simplex
+		# may pick another one than distort_point
+		points = np.float64(points).reshape(-1, 2)
+		indices = locate_polygons(points, [t1 for (t1, _) in self.triangle_pairs])
+		return apply_affines(points, indices, self.forward)
+
+	def undistort_points(self, points):
+		# target triangles need not form a Delaunay triangulation of the target points
+		points = np.float64(points).reshape(-1, 2)
+		indices = locate_polygons(points, [t2 for (_, t2) in self.triangle_pairs])
+		return apply_affines(points, indices, self.inverse)
+
+def padded_polygons(polygons):
+	# triangles as quadrilaterals with a repeated corner, which in_polygons accepts
+	return np.float64([tuple(t) + (t[-1],) * (4 - len(t)) for t in polygons]).reshape(-1, 4, 2)
+
+@timed('polygon_transforms')
+def polygon_transforms(polygon_pairs, bilinear):
+	# per polygon a projective matrix, or for bilinear quads a row of the bilinear table,
+	# each between frames normalized as in rendering, followed by the offsets of those frames
+	kinds = np.zeros(len(polygon_pairs), dtype=np.int64)
+	projective = np.zeros((len(polygon_pairs), 13))
+	bilinear_maps = []
+	bilinear_offsets = []
+	bilinear_indices = np.zeros(len(polygon_pairs), dtype=np.int64)
+	for i, (t1, t2) in enumerate(polygon_pairs):
+		t1_norm, x1, y1, _, _ = normalize_polygon(t1)
+		t2_norm, x2, y2, _, _ = normalize_polygon(t2)
+		if len(t1) == 3:
+			projective[i, :6] = np.ravel(triangles_to_affine(t1_norm, t2_norm))
+			projective[i, 6:9] = (0, 0, 1)
+		elif bilinear:
+			kinds[i] = 1
+			bilinear_indices[i] = len(bilinear_maps)
+			bilinear_maps.append(BilinearMap(t1_norm, t2_norm))
+			bilinear_offsets.append((x1, y1, x2, y2))
+		else:
+			projective[i, :9] = quads_to_transform(t1_norm, t2_norm).ravel()
+		projective[i, 9:] = (x1, y1, x2, y2)
+	table = np.hstack((bilinear_table(bilinear_maps), np.float64(bilinear_offsets).reshape(-1, 4)))
+	return kinds, projective, bilinear_indices, table
+
+def inverse_polygon_transforms(polygon_pairs, bilinear):
+	# quadrilaterals are inverted as in quad_source_coords, triangles as in undistort_point
+	kinds, projective, bilinear_indices, table = \
+		polygon_transforms([(t2, t1) for (t1, t2) in polygon_pairs], bilinear)
+	for i, (t1, t2) in enumerate(polygon_pairs):
+		if len(t1) == 4 and not bilinear:
+			t1_norm, _, _, _, _ = normalize_polygon(t1)
+			t2_norm, _, _, _, _ = normalize_polygon(t2)
+			_, inv = cv2.invert(quads_to_transform(t1_norm, t2_norm))
+			projective[i, :9] = inv.ravel()
+	return kinds, projective, bilinear_indices, table
+
+def apply_polygon_transforms(points, indices, transforms):
+	kinds, projective, bilinear_indices, table = transforms
+	mapped = np.full(points.shape, np.nan)
+	inside = indices >= 0
+	flat = inside & (kinds[np.maximum(indices, 0)] == 0)
+	m = projective[indices[flat]]
+	xs = points[flat, 0] - m[:, 9]
+	ys = points[flat, 1] - m[:, 10]
+	ws = m[:, 6] * xs + m[:, 7] * ys + m[:, 8]
+	mapped[flat, 0] = (m[:, 0] * xs + m[:, 1] * ys + m[:, 2]) / ws + m[:, 11]
+	mapped[flat, 1] = (m[:, 3] * xs + m[:, 4] * ys + m[:, 5]) / ws + m[:, 12]
+	curved = inside & ~flat
+	rows = bilinear_indices[indices[curved]]
+	offsets = table[rows, -4:]
+	xs_dest, ys_dest = map_bilinear_table(table, rows, \
+		points[curved, 0] - offsets[:, 0], points[curved, 1] - offsets[:, 1])
+	mapped[curved, 0] = xs_dest + offsets[:, 2]
+	mapped[curved, 1] = ys_dest + offsets[:, 3]
+	return mapped, ~inside
+
+class PolygonMapping:
+	# point mapping by merged polygons, as rendered in the Quadrilaterals and Bilinear modes
+	def __init__(self, polygon_pairs, bilinear):
+		self.polygon_pairs = polygon_pairs
+		self.sources = padded_polygons([t1 for (t1, _) in polygon_pairs])
+		self.targets = padded_polygons([t2 for (_, t2) in polygon_pairs])
+		self.forward = polygon_transforms(polygon_pairs, bilinear)
+		self.inverse = inverse_polygon_transforms(polygon_pairs, bilinear)
+
+	def distort_points(self, points):
+		points = np.float64(points).reshape(-1, 2)
+		return apply_polygon_transforms(points, locate_polygons(points, self.sources), self.forward)
+
+	def undistort_points(self, points):
+		points = np.float64(points).reshape(-1, 2)
+		return apply_polygon_transforms(points, locate_polygons(points, self.targets), self.inverse)
+
+def distort_points(in_points, transform):
+	mapped, outside = transform.distort_points(in_points)
 	out_points = []
-	for point in in_points:
-		distorted = distort_point(point[0], point[1], triangle_pairs)
-		if distorted is None:
+	for point, (x, y), ignored in zip(in_points, mapped, outside):
+		if ignored:
 			print('Ignored', point)
 		else:
-			out_points.append(distorted)
+			out_points.append((int(x), int(y)))
 	return out_points
 
+def make_grid(w, h):
+	# read-only, as cached grids are shared between callers
+	grid = np.empty((h, w, 2), dtype=np.float32)
+	grid[:, :, 0] = np.arange(w, dtype=np.float32)
+	grid[:, :, 1] = np.arange(h, dtype=np.float32)[:, np.newaxis]
+	grid.flags.writeable = False
+	return grid
+
+@functools.lru_cache(maxsize=GRID_CACHE_SIZE)
+def cached_grid(w, h):
+	return make_grid(w, h)
+
 def get_grid(w, h):
-	xs = np.stack([np.arange(0, w) for _ in range(h)]).astype(np.float32)
-	ys = np.stack([np.arange(0, h) for _ in range(w)]).astype(np.float32).T
-	return np.concatenate([xs[..., np.newaxis], ys[..., np.newaxis]], 2)
+	if w * h > GRID_CACHE_PIXELS:
+		return make_grid(w, h)
+	return cached_grid(w, h)
+
+@timed('tps_fit')
+def estimate_tps(pts_src, pts_dst, matches):
+	tps = cv2.createThinPlateSplineShapeTransformer()
+	tps.estimateTransformation(pts_src, pts_dst, matches)
+	return tps
 
 def warp_image(source, pts_src, pts_dst, matches, w, h):
-	w_source, h_source = source.size
+	return warp_image_tps(source, estimate_tps(pts_src, pts_dst, matches), w, h)
+
+def warp_image_tps(source, tps, w, h, fixed_point=FIXED_POINT_MAPS):
+	return warp_image_grid(source, warp_grid(tps, w, h), w, h, fixed_point)
+
+def warp_image_approx(source, tps, w, h, tolerance=WARP_TOLERANCE, fixed_point=FIXED_POINT_MAPS):
+	grid_warped, error = approximate_warp_grid(tps, w, h, tolerance)
+	return warp_image_grid(source, grid_warped, w, h, fixed_point), error
+
+def warp_image_grid(source, grid_warped, w, h, fixed_point=FIXED_POINT_MAPS):
+	source = as_array(source)
+	w_source, h_source = image_size(source)
 	w_max = max(w, w_source)
 	h_max = max(h, h_source)
 	bottom = h_max - h_source
 	right = w_max - w_source
-	source_cv = cv2.cvtColor(np.array(source), cv2.COLOR_RGB2BGR)
-	source_cv = cv2.copyMakeBorder(source_cv, 0, bottom, 0, right, \
-			cv2.BORDER_CONSTANT, value=(255,255,255))
-	grid = get_grid(w, h)
-	tps = cv2.createThinPlateSplineShapeTransformer()
-	tps.estimateTransformation(pts_src, pts_dst, matches)
-	grid_warped = tps.applyTransformation(grid.reshape(1, -1, 2))[1].reshape(h, w, 2)
-	target_cv = cv2.remap(source_cv, grid_warped[:, :, 0], grid_warped[:, :, 1], cv2.INTER_LINEAR)
-	target = Image.fromarray(cv2.cvtColor(target_cv, cv2.COLOR_BGR2RGB))
-	target = target.crop((0, 0, w, h))
-	return target
+	# padded with white only if the target is larger, as the padding copies the source
+	if bottom > 0 or right > 0:
+		padded = np.full((h_max, w_max) + source.shape[2:], white_value(source.dtype), dtype=source.dtype)
+		padded[:h_source, :w_source] = source
+		source = padded
+	# the grid itself is a two-channel map
+	map1, map2 = np.ascontiguousarray(grid_warped), None
+	if fixed_point:
+		map1, map2 = compact_maps(map1, map2, (w_max, h_max))
+	with timing.stage('remap'):
+		return remap_channels(source, map1, map2, cv2.INTER_LINEAR)
+
+def view_to_image(grid, view):
+	if view is None:
+		return grid
+	(x, y, scale_x, scale_y) = view
+	return (grid + 0.5) / np.float32([scale_x, scale_y]) - 0.5 + np.float32([x, y])
+
+@timed('warp_grid')
+def warp_grid(tps, w, h, view=None):
+	grid = view_to_image(get_grid(w, h), view)
+	return tps.applyTransformation(grid.reshape(1, -1, 2))[1].reshape(h, w, 2)
+
+def lattice_warp_grid(tps, w, h, step, view=None):
+	# lattice points at the centres of step x step blocks, so that resizing by step
+	# puts them exactly on the pixel grid, and one block beyond each edge
+	cols = math.ceil(w / step) + 2
+	rows = math.ceil(h / step) + 2
+	lattice = view_to_image((get_grid(cols, rows) - 1) * step + (step - 1) / 2, view)
+	lattice_warped = tps.applyTransformation(lattice.reshape(1, -1, 2))[1].reshape(rows, cols, 2)
+	grid_warped = cv2.resize(lattice_warped, (cols * step, rows * step), interpolation=cv2.INTER_LINEAR)
+	return grid_warped[step:step+h, step:step+w]
+
+def exact_warp_samples(tps, w, h, spacing, known=None, factor=2, view=None):
+	# the warp of every spacing-th pixel of every spacing-th row, of which every factor-th one
+	# in both directions is known already
+	grid = get_grid(math.ceil(w / spacing), math.ceil(h / spacing))
+	grid = view_to_image(grid if spacing == 1 else grid * np.float32(spacing), view)
+	if known is None:
+		return tps.applyTransformation(grid.reshape(1, -1, 2))[1].reshape(grid.shape)
+	exact = np.empty(grid.shape, dtype=np.float32)
+	exact[::factor, ::factor] = known
+	missing = np.ones(grid.shape[:2], dtype=bool)
+	missing[::factor, ::factor] = False
+	exact[missing] = tps.applyTransformation(grid[missing].reshape(1, -1, 2))[1].reshape(-1, 2)
+	return exact
+
+def lattice_error(grid_warped, exact, spacing):
+	return float(np.abs(exact - grid_warped[::spacing, ::spacing]).max())
+
+@timed('approximate_warp_grid')
+def approximate_warp_grid(tps, w, h, tolerance, view=None):
+	step = WARP_MAX_STEP
+	exact = None
+	while step >= WARP_MIN_STEP:
+		grid_warped = lattice_warp_grid(tps, w, h, step, view)
+		# every other sample lies midway between lattice points, and the samples of a step
+		# are among those of the next
+		exact = exact_warp_samples(tps, w, h, step // 2, exact, view=view)
+		error = lattice_error(grid_warped, exact, step // 2)
+		if error <= tolerance:
+			return grid_warped, error
+		step //= 2
+	# the exact grid, but for the samples of the last check
+	return exact_warp_samples(tps, w, h, 1, exact, WARP_MIN_STEP // 2, view), 0.0
 
 def unwarp_point(x, y, pts_dst, pts_src, matches):
-	tps = cv2.createThinPlateSplineShapeTransformer()
-	tps.estimateTransformation(pts_src, pts_dst, matches)
+	return unwarp_point_tps(x, y, estimate_tps(pts_src, pts_dst, matches))
+
+def unwarp_point_tps(x, y, tps):
 	in_p = np.array([(x,y)], np.float32).reshape((-1,1,2))
 	out_p = tps.applyTransformation(in_p)
 	return round(out_p[1][0][0][0]), round(out_p[1][0][0][1])
 
+class CompiledTransform:
+	def __init__(self, point_pairs, poly_mode):
+		self.point_pairs = tuple(point_pairs)
+		self.poly_mode = poly_mode
+		if poly_mode == 'w':
+			pts_dst, pts_src, matches = split_point_pairs(self.point_pairs)
+			self.tps = estimate_tps(pts_src, pts_dst, matches)
+			self.forward_tps = None
+		else:
+			self.mapping = PointMapping(self.point_pairs)
+			pairs = self.mapping.triangle_pairs
+			if poly_mode == 'q' or poly_mode == 'b':
+				pairs = merge_triangles(pairs, self.mapping.delaunay.neighbors)
+			# in a fixed order, which decides the polygon of pixels on shared edges, so that every
+			# render path and every edit gives them the same one
+			self.pairs = sorted(pairs)
+			if poly_mode == 'q' or poly_mode == 'b':
+				self.mapping = PolygonMapping(self.pairs, poly_mode == 'b')
+
+	def is_compiled_for(self, point_pairs, poly_mode):
+		return self.poly_mode == poly_mode and self.point_pairs == tuple(point_pairs)
+
+	def distort_points(self, points):
+		if self.poly_mode == 'w':
+			if self.forward_tps is None:
+				pts_dst, pts_src, matches = split_point_pairs(self.point_pairs)
+				self.forward_tps = estimate_tps(pts_dst, pts_src, matches)
+			return apply_tps(self.forward_tps, points)
+		return self.mapping.distort_points(points)
+
+	def undistort_points(self, points):
+		if self.poly_mode == 'w':
+			return apply_tps(self.tps, points)
+		return self.mapping.undistort_points(points)
+
+	def undistort_point(self, x, y):
+		if self.poly_mode == 'w':
+			return unwarp_point_tps(x, y, self.tps)
+		mapped, outside = self.mapping.undistort_points([(x, y)])
+		if outside[0]:
+			return None
+		return (int(mapped[0][0]), int(mapped[0][1]))
+
+def apply_tps(tps, points):
+	points = np.float32(points).reshape(1, -1, 2)
+	mapped = tps.applyTransformation(points)[1].reshape(-1, 2)
+	return np.float64(mapped), np.zeros(len(mapped), dtype=bool)
+
+def complete_point_pairs(point_pairs, image1, image2):
+	return complete_point_pairs_size(point_pairs, image_size(image1), image_size(image2))
+
+def complete_point_pairs_size(point_pairs, size1, size2):
+	w1, h1 = size1
+	w2, h2 = size2
+	top_left1 = (0, 0)
+	top_left2 = (0, 0)
+	top_right1 = (w1-1, 0)
+	top_right2 = (w2-1, 0)
+	bottom_left1 = (0, h1-1)
+	bottom_left2 = (0, h2-1)
+	bottom_right1 = (w1-1, h1-1)
+	bottom_right2 = (w2-1, h2-1)
+	points1 = [p1 for (_,p1) in point_pairs]
+	points2 = [p2 for (p2,_) in point_pairs]
+	completed = point_pairs[:]
+	if top_left1 not in points1 and top_left2 not in points2:
+		completed.append((top_left2, top_left1))
+	if top_right1 not in points1 and top_right2 not in points2:
+		completed.append((top_right2, top_right1))
+	if bottom_left1 not in points1 and bottom_left2 not in points2:
+		completed.append((bottom_left2, bottom_left1))
+	if bottom_right1 not in points1 and bottom_right2 not in points2:
+		completed.append((bottom_right2, bottom_right1))
+	return completed
+
 def read_point_pairs(path):
 	if not os.path.isfile(path):
 		return []
@@ -325,14 +887,26 @@ def write_points(points, path):
 			writer.writerow([x, y])
 
 if __name__ == '__main__':
-	if len(sys.argv) != 4:
+	poly_mode = 't'
+	try:
+		opts, vals = getopt(sys.argv[1:], 'm:', ['mode='])
+	except GetoptError as err:
+		print(err)
+		sys.exit(1)
+	if len(vals) != 3:
 		print('Required are file with point pairs, and two files with input and output points')
 		sys.exit(1) 
-	pair_file = sys.argv[1]
-	in_file = sys.argv[2]
-	out_file = sys.argv[3]
+	for opt, val in opts:
+		if opt in ('-m', '--mode'):
+			poly_mode = val
+	if poly_mode not in ['t', 'q', 'b', 'w']:
+		print('Mode must be one of: t, q, b, w')
+		sys.exit(1)
+	pair_file = vals[0]
+	in_file = vals[1]
+	out_file = vals[2]
 	point_pairs = read_point_pairs(pair_file)
-	triangle_pairs = point_pairs_to_triangle_pairs(point_pairs)
+	transform = CompiledTransform(point_pairs, poly_mode)
 	in_points = read_points(in_file)
-	out_points = distort_points(in_points, triangle_pairs)
+	out_points = distort_points(in_points, transform)
 	write_points(out_points, out_file)
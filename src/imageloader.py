@@ -0,0 +1,51 @@
+import threading
+
+from imagearray import as_array, image_size, file_image_size, reduction_factor, load_reduced, load_image
+from timing import timing
+
+class ImageLoader:
+	def __init__(self, path):
+		# a reduced image is decoded first, and the full image in the background once started
+		self.path = path
+		self.size = file_image_size(path)
+		self.factor = reduction_factor(self.size)
+		with timing.stage('load_reduced', path=path, factor=self.factor):
+			self.reduced, self.image = load_reduced(path, self.factor)
+		self.error = None
+		self.thread = None
+
+	@classmethod
+	def of_image(cls, image):
+		loader = cls.__new__(cls)
+		loader.path = None
+		loader.image = as_array(image)
+		loader.size = image_size(loader.image)
+		loader.factor = 1
+		loader.reduced = loader.image
+		loader.error = None
+		loader.thread = None
+		return loader
+
+	def start(self):
+		if self.image is None and self.thread is None:
+			self.thread = threading.Thread(target=self.load, daemon=True)
+			self.thread.start()
+
+	def load(self):
+		try:
+			with timing.stage('load', path=self.path):
+				self.image = load_image(self.path)
+		except Exception as err:
+			self.error = err
+
+	def done(self):
+		return self.image is not None or self.error is not None
+
+	def full(self):
+		# waiting for the full image if it is still being loaded
+		self.start()
+		if self.thread is not None:
+			self.thread.join()
+		if self.error is not None:
+			raise self.error
+		return self.image
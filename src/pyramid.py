@@ -0,0 +1,51 @@
+import math
+from collections import OrderedDict
+
+class ImagePyramid:
+	def __init__(self, image, factor=1):
+		# level k is the image reduced by factor 2**k, built when first needed; an image that is
+		# already reduced by a power of two is the level of that factor, and finer levels are absent
+		self.base = factor.bit_length() - 1
+		self.levels = [None] * self.base + [image]
+
+	def level(self, k):
+		while len(self.levels) <= k:
+			self.levels.append(self.levels[-1].reduce(2))
+		return self.levels[k]
+
+	def level_for(self, scale):
+		# coarsest level that still has at least the resolution of the canvas, if available
+		if scale >= 1:
+			return self.base
+		k = max(math.floor(math.log2(1 / scale)), self.base)
+		w, h = self.levels[self.base].size
+		while k > self.base and (w >> (k - self.base) < 1 or h >> (k - self.base) < 1):
+			k -= 1
+		return k
+
+	def crop_resized(self, box, size):
+		x_min, y_min, x_max, y_max = box
+		k = self.level_for(size[0] / (x_max - x_min))
+		f = 2 ** k
+		x0, y0 = math.floor(x_min / f), math.floor(y_min / f)
+		x1, y1 = math.ceil(x_max / f), math.ceil(y_max / f)
+		# cropping pads with black outside the image, and resizing samples the exact box
+		cropped = self.level(k).crop((x0, y0, x1, y1))
+		return cropped.resize(size, box=(x_min / f - x0, y_min / f - y0, x_max / f - x0, y_max / f - y0))
+
+class LRUCache:
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.entries = OrderedDict()
+
+	def get(self, key, make):
+		if key in self.entries:
+			self.entries.move_to_end(key)
+		else:
+			self.entries[key] = make()
+			if len(self.entries) > self.capacity:
+				self.entries.popitem(last=False)
+		return self.entries[key]
+
+	def clear(self):
+		self.entries.clear()
@@ -0,0 +1,64 @@
+import threading
+import queue
+import traceback
+
+class RenderWorker:
+	def __init__(self):
+		self.condition = threading.Condition()
+		# per kind of job, only the latest submitted one is kept
+		self.pending = {}
+		self.latest = {}
+		self.running = None
+		self.results = queue.Queue()
+		self.lock = threading.Lock()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def submit(self, kind, key, render):
+		with self.condition:
+			if kind in self.latest and self.latest[kind] == key:
+				return
+			self.pending[kind] = (key, render)
+			self.latest[kind] = key
+			self.condition.notify()
+
+	def run(self):
+		while True:
+			with self.condition:
+				while len(self.pending) == 0:
+					self.condition.wait()
+				kind = next(iter(self.pending))
+				key, render = self.pending.pop(kind)
+				self.running = kind
+			with self.lock:
+				try:
+					result = render()
+					error = None
+				except Exception:
+					result = None
+					error = traceback.format_exc()
+			with self.condition:
+				self.running = None
+				superseded = self.latest[kind] != key
+			if not superseded:
+				self.results.put((kind, key, result, error))
+
+	def forget(self, kind, key):
+		# so that the job is run again when next submitted, as after it failed
+		with self.condition:
+			if self.latest.get(kind) == key:
+				del self.latest[kind]
+
+	def run_now(self, render):
+		with self.lock:
+			return render()
+
+	def busy(self):
+		with self.condition:
+			return len(self.pending) > 0 or self.running is not None or not self.results.empty()
+
+	def finished(self):
+		results = []
+		while not self.results.empty():
+			results.append(self.results.get())
+		return results
@@ -0,0 +1,193 @@
+import sys
+import math
+import numpy as np
+import cv2
+from getopt import getopt, GetoptError
+from PIL import Image
+
+from imagedistortion import CompiledTransform, polygon_labels, polygon_source_maps, linear_labels, \
+		get_grid, complete_point_pairs_size, read_point_pairs
+from imagearray import load_image, file_image_size, image_size, white_value, remap_channels
+
+MODES = ['t', 'q', 'b', 'w']
+TILE_SIZE = 1024
+# tifffile writes tiles of multiples of this size
+TIFF_TILE_MULTIPLE = 16
+# sources that cannot be memory-mapped are decoded as a whole, up to this size
+MAX_DECODED_PIXELS = 100000000
+# the arrays of the modes of images that a TIFF file may be memory-mapped as
+MEMMAP_MODES = {'L': (np.uint8, ()), 'LA': (np.uint8, (2,)), 'RGB': (np.uint8, (3,)), \
+	'RGBA': (np.uint8, (4,)), 'I;16': (np.uint16, ()), 'F': (np.float32, ())}
+# taps of cubic interpolation reach from one pixel before to two pixels after
+INTERPOLATION_MARGIN = 3
+
+def read_window(source, x0, y0, x1, y1):
+	# from an array, which for a memory-mapped source reads only the window
+	return np.ascontiguousarray(source[y0:y1, x0:x1])
+
+def sample_shape(source):
+	sample = read_window(source, 0, 0, 1, 1)
+	return sample.shape[2:], sample.dtype
+
+def source_window(map_x, map_y, mask, w, h):
+	if not mask.any():
+		return None
+	x0 = max(math.floor(map_x[mask].min()) - INTERPOLATION_MARGIN, 0)
+	y0 = max(math.floor(map_y[mask].min()) - INTERPOLATION_MARGIN, 0)
+	x1 = min(math.ceil(map_x[mask].max()) + INTERPOLATION_MARGIN + 1, w)
+	y1 = min(math.ceil(map_y[mask].max()) + INTERPOLATION_MARGIN + 1, h)
+	if x0 >= x1 or y0 >= y1:
+		return None
+	return x0, y0, x1, y1
+
+def read_padded_window(source, x0, y0, x1, y1, shape, dtype):
+	# the window may extend beyond the source, into white padding
+	w_source, h_source = image_size(source)
+	padded = np.full((y1-y0, x1-x0) + shape, white_value(dtype), dtype=dtype)
+	if x0 < w_source and y0 < h_source:
+		inner = read_window(source, x0, y0, min(x1, w_source), min(y1, h_source))
+		padded[:inner.shape[0], :inner.shape[1]] = inner
+	return padded
+
+def remap_window(window, map_x, map_y, x0, y0, interpolation):
+	# subtracting whole pixels from float32 maps is exact, so the result equals that of
+	# remapping the whole source
+	return remap_channels(window, map_x - np.float32(x0), map_y - np.float32(y0), interpolation)
+
+def render_polygon_tile(source, pairs, bilinear, x, y, w, h, target):
+	labels = polygon_labels(pairs, x, y, w, h)
+	map_x, map_y = polygon_source_maps(pairs, labels, x, y, bilinear)
+	w_source, h_source = image_size(source)
+	window = source_window(map_x, map_y, labels > 0, w_source, h_source)
+	target[:] = 0
+	if window is not None:
+		x0, y0, x1, y1 = window
+		window = read_window(source, x0, y0, x1, y1)
+		remapped = remap_window(window, map_x, map_y, x0, y0, cv2.INTER_CUBIC)
+		target[labels > 0] = remapped[labels > 0]
+		linear = linear_labels(pairs, labels, bilinear)
+		if linear is not None and linear.any():
+			remapped = remap_window(window, map_x, map_y, x0, y0, cv2.INTER_LINEAR)
+			target[linear] = remapped[linear]
+
+def render_warp_tile(source, tps, w_padded, h_padded, x, y, w, h, target):
+	grid = get_grid(w, h) + np.float32([x, y])
+	grid_warped = tps.applyTransformation(grid.reshape(1, -1, 2))[1].reshape(h, w, 2)
+	map_x = np.ascontiguousarray(grid_warped[:, :, 0])
+	map_y = np.ascontiguousarray(grid_warped[:, :, 1])
+	window = source_window(map_x, map_y, np.ones((h, w), dtype=bool), w_padded, h_padded)
+	target[:] = 0
+	if window is not None:
+		# as warp_image_grid, white up to the padded size and black beyond
+		x0, y0, x1, y1 = window
+		padded = read_padded_window(source, x0, y0, x1, y1, target.shape[2:], target.dtype)
+		target[:] = remap_window(padded, map_x, map_y, x0, y0, cv2.INTER_LINEAR)
+
+def tile_rects(w, h, tile):
+	for y in range(0, h, tile):
+		for x in range(0, w, tile):
+			yield x, y, min(tile, w - x), min(tile, h - y)
+
+def render_tiles(source, transform, w, h, tile=TILE_SIZE):
+	shape, dtype = sample_shape(source)
+	w_source, h_source = image_size(source)
+	for (x, y, w_tile, h_tile) in tile_rects(w, h, tile):
+		target = np.zeros((h_tile, w_tile) + shape, dtype=dtype)
+		if transform.poly_mode == 'w':
+			render_warp_tile(source, transform.tps, max(w, w_source), max(h, h_source), \
+				x, y, w_tile, h_tile, target)
+		else:
+			render_polygon_tile(source, transform.pairs, transform.poly_mode == 'b', \
+				x, y, w_tile, h_tile, target)
+		yield x, y, target
+
+def render_to_memmap(source, transform, w, h, path, tile=TILE_SIZE):
+	shape, dtype = sample_shape(source)
+	out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(h, w) + shape)
+	for (x, y, target) in render_tiles(source, transform, w, h, tile):
+		out[y:y+target.shape[0], x:x+target.shape[1]] = target
+		out.flush()
+	del out
+
+def check_tiff_tile(tile):
+	if tile <= 0 or tile % TIFF_TILE_MULTIPLE != 0:
+		raise ValueError('Tiles of TIFF files must be a positive multiple of %d pixels, not %d' % \
+			(TIFF_TILE_MULTIPLE, tile))
+
+def render_to_tiff(source, transform, w, h, path, tile=TILE_SIZE):
+	import tifffile
+	check_tiff_tile(tile)
+	shape, dtype = sample_shape(source)
+	def padded_tiles():
+		for (_, _, target) in render_tiles(source, transform, w, h, tile):
+			padded = np.zeros((tile, tile) + shape, dtype=dtype)
+			padded[:target.shape[0], :target.shape[1]] = target
+			yield padded
+	tifffile.imwrite(path, padded_tiles(), shape=(h, w) + shape, dtype=dtype, tile=(tile, tile))
+
+def render_to_file(source, transform, w, h, path, tile=TILE_SIZE):
+	if path.lower().endswith('.npy'):
+		render_to_memmap(source, transform, w, h, path, tile)
+	elif path.lower().endswith('.tif') or path.lower().endswith('.tiff'):
+		render_to_tiff(source, transform, w, h, path, tile)
+	else:
+		raise ValueError('Tiled output must be .tif, .tiff or .npy: ' + path)
+
+def memmap_tiff(path):
+	# an uncompressed TIFF file whose pixels are stored contiguously, as the same array as
+	# load_image gives, or None
+	try:
+		import tifffile
+		with Image.open(path) as image:
+			dtype, shape = MEMMAP_MODES[image.mode]
+			size = image.size
+		source = tifffile.memmap(path, mode='r')
+	except (ImportError, KeyError, ValueError):
+		return None
+	if source.dtype != dtype or source.shape != (size[1], size[0]) + shape:
+		return None
+	return source
+
+def open_source(path):
+	# sources other than .npy and uncompressed TIFF files are decoded as a whole
+	if path.lower().endswith('.npy'):
+		return load_image(path)
+	if path.lower().endswith('.tif') or path.lower().endswith('.tiff'):
+		source = memmap_tiff(path)
+		if source is not None:
+			return source
+	w, h = file_image_size(path)
+	if w * h > MAX_DECODED_PIXELS:
+		raise ValueError('Sources of more than %d pixels must be .npy or uncompressed .tif files: %s' % \
+			(MAX_DECODED_PIXELS, path))
+	return load_image(path)
+
+if __name__ == '__main__':
+	tile = TILE_SIZE
+	poly_mode = 't'
+	try:
+		opts, vals = getopt(sys.argv[1:], 's:m:', ['tilesize=', 'mode='])
+	except GetoptError as err:
+		print(err)
+		sys.exit(1)
+	if len(vals) != 4:
+		print('Required are two images, a file with point pairs, and an output file (.tif or .npy)')
+		sys.exit(1)
+	for opt, val in opts:
+		if opt in ('-s', '--tilesize'):
+			tile = int(val)
+		elif opt in ('-m', '--mode'):
+			poly_mode = val
+	if poly_mode not in MODES:
+		print('Mode must be one of: ' + ', '.join(MODES))
+		sys.exit(1)
+	is_tiff = vals[3].lower().endswith('.tif') or vals[3].lower().endswith('.tiff')
+	if tile <= 0 or is_tiff and tile % TIFF_TILE_MULTIPLE != 0:
+		print('Tile size must be positive, and for TIFF output a multiple of %d' % TIFF_TILE_MULTIPLE)
+		sys.exit(1)
+	image1 = Image.open(vals[0])
+	image2 = open_source(vals[1])
+	w, h = image1.size
+	point_pairs = complete_point_pairs_size(read_point_pairs(vals[2]), (w, h), image_size(image2))
+	transform = CompiledTransform(point_pairs, poly_mode)
+	render_to_file(image2, transform, w, h, vals[3], tile)
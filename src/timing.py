@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+
+# timing is enabled by this environment variable, of which the value is the file to which records
+# are appended as JSON lines, or '-' for standard error
+TIMING_VARIABLE = 'IMAGEALIGN_TIMING'
+
+class NoStage:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+NO_STAGE = NoStage()
+
+class Stage:
+	def __init__(self, timing, name, fields):
+		self.timing = timing
+		self.name = name
+		self.fields = fields
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		self.timing.record(self.name, time.perf_counter() - self.start, self.fields)
+		return False
+
+class Timing:
+	def __init__(self):
+		self.enabled = False
+		self.handle = None
+		self.lock = threading.Lock()
+		# per thread, the time per stage within the work being collected
+		self.local = threading.local()
+		self.breakdowns = {}
+
+	def enable(self, path):
+		self.handle = sys.stderr if path == '-' else open(path, 'a', buffering=1)
+		self.enabled = True
+
+	def stage(self, name, **fields):
+		# when disabled, the same object that does nothing
+		if not self.enabled:
+			return NO_STAGE
+		return Stage(self, name, fields)
+
+	def record(self, name, seconds, fields=None):
+		record = {'stage': name, 'seconds': round(seconds, 6), 'time': round(time.time(), 3), \
+			'thread': threading.current_thread().name}
+		if fields:
+			record.update(fields)
+		with self.lock:
+			self.handle.write(json.dumps(record) + '\n')
+		stages = getattr(self.local, 'stages', None)
+		if stages is not None:
+			stages[name] = stages.get(name, 0) + seconds
+
+	def collected(self, label, f):
+		# runs f, and keeps the time of each stage within it as the breakdown of label
+		if not self.enabled:
+			return f()
+		self.local.stages = {}
+		try:
+			with self.stage(label):
+				return f()
+		finally:
+			self.breakdowns[label] = self.local.stages
+			self.local.stages = None
+
+	def summary(self, label):
+		stages = self.breakdowns.get(label)
+		if stages is None or label not in stages:
+			return ''
+		parts = ['%s %.1f' % (name, 1000 * seconds) for (name, seconds) in stages.items() if name != label]
+		return '%s %.0f ms' % (label, 1000 * stages[label]) + (' (%s)' % ', '.join(parts) if parts else '')
+
+timing = Timing()
+if os.environ.get(TIMING_VARIABLE):
+	timing.enable(os.environ[TIMING_VARIABLE])
+
+def timed(name):
+	def decorate(f):
+		@functools.wraps(f)
+		def wrapper(*args, **kwargs):
+			if not timing.enabled:
+				return f(*args, **kwargs)
+			with Stage(timing, name, {}):
+				return f(*args, **kwargs)
+		return wrapper
+	return decorate